@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare two benchmark results of run.py, startup.py or memory.py.
+
+Usage:
+  compare.py [options] <baseline> <current>
+
+Print the timings, or the bytes per file, of both results side by side,
+and exit with a non-zero status if any of the <current> ones regressed by
+more than the threshold.
+
+Options:
+  --threshold=<pct>   The tolerated regression, in percent [default: 10].
+"""
+
+from __future__ import print_function
+import json
+import sys
+
+from docopt import docopt
+
+
+# the measures of the results, and their format.
+MEASURES = (
+    ('timings', 'timing', '%.4f'),
+    ('bytes_per_file', 'bytes per file', '%d'),
+)
+
+
+def compare(baseline, current, threshold):
+    """Yield (name, baseline, current, change, regressed) for each
+    measure."""
+    for name in sorted(set(baseline) | set(current)):
+        before, after = baseline.get(name), current.get(name)
+        if not before or after is None:
+            yield name, before, after, None, False
+            continue
+        change = (after - before) / before * 100
+        yield name, before, after, change, change > threshold
+
+
+def main(argv=None):
+    args = docopt(__doc__, argv=argv)
+    baseline = json.load(open(args['<baseline>']))
+    current = json.load(open(args['<current>']))
+    for result in (baseline, current):
+        meta = result['meta']
+        # the start up results of startup.py do not run over a library,
+        # the memory results of memory.py do not run jobs.
+        library = ('%d files, ' % meta['files'] if 'files' in meta else '')
+        if 'jobs' in meta:
+            library += '%d jobs, ' % meta['jobs']
+        print('%s: %spython %s, mutagen %s' % (
+            meta['commit'], library, meta['python'], meta['mutagen']))
+    if baseline['meta'].get('files') != current['meta'].get('files'):
+        print('warning: the libraries do not have the same size')
+    print()
+
+    regressions = 0
+    for key, title, format in MEASURES:
+        if key not in baseline or key not in current:
+            continue
+        print('%-20s %10s %10s %8s' % (title, 'baseline', 'current',
+                                       'change'))
+        for name, before, after, change, regressed in compare(
+                baseline[key], current[key], float(args['--threshold'])):
+            print('%-20s %10s %10s %8s%s' % (
+                name,
+                '-' if before is None else format % before,
+                '-' if after is None else format % after,
+                '-' if change is None else '%+.1f%%' % change,
+                '  REGRESSION' if regressed else ''))
+            regressions += regressed
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Generate a synthetic audio library from the test fixtures.
+
+Usage:
+  generate.py [options] <dir>
+
+The library is laid out as <dir>/artist-NNN/album-NNN/NN.{mp3,m4a}, with
+12 tracks per album and 5 albums per artist, alternating MP3 and M4A files.
+The titles vary from a few bytes to a few kilobytes, so that the tags do
+not all fit in the padding of the fixtures.
+
+Options:
+  -n, --files=<n>     Number of files to generate [default: 1000].
+  --seed=<seed>       Seed of the random tag sizes [default: 0].
+"""
+
+from __future__ import print_function
+import os
+import random
+import shutil
+import sys
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tagcli import load, save  # noqa
+
+FIXTURES = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'tests', 'data')
+ORIGINALS = {
+    '.mp3': os.path.join(FIXTURES, 'silence-44-s-v1.mp3'),
+    '.m4a': os.path.join(FIXTURES, 'has-tags.m4a'),
+}
+TRACKS, ALBUMS = 12, 5
+
+
+def generate(top, count, seed=0):
+    """Generate `count` tagged files under `top`, return their paths."""
+    rand = random.Random(seed)
+    files = []
+    for i in range(count):
+        album, track = divmod(i, TRACKS)
+        artist, album = divmod(album, ALBUMS)
+        ext = ('.mp3', '.m4a')[i % 2]
+        dirname = os.path.join(top, 'artist-%03d' % artist,
+                               'album-%03d' % album)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        filename = os.path.join(dirname, '%02d%s' % (track + 1, ext))
+        shutil.copy(ORIGINALS[ext], filename)
+
+        meta = load(filename)
+        meta.update({
+            'artist': u'Artist %d' % artist,
+            'albumartist': u'Artist %d' % artist,
+            'album': u'Album %d of Artist %d' % (album, artist),
+            'title': u'Title %d ' % track + u'x' * int(
+                rand.expovariate(1.0 / 200)),
+            'tracknumber': u'%d/%d' % (track + 1, TRACKS),
+            'discnumber': u'1',
+        })
+        save(meta, filename)
+        files.append(filename)
+    return files
+
+
+def main(argv=None):
+    args = docopt(__doc__, argv=argv)
+    files = generate(args['<dir>'], int(args['--files']),
+                     int(args['--seed']))
+    print('%d files generated in %s' % (len(files), args['<dir>']))
+
+
+if __name__ == '__main__':
+    main()
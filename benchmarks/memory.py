@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Measure the memory held per file by the tags kept for a library, and
+emit the results as JSON.
+
+Usage:
+  memory.py [options]
+
+Each measure keeps the tags of --files synthetic files, shaped like the ones
+of generate.py, in a fresh process, and reports the growth of its resident
+memory divided by the number of files, in bytes: as TagRecord, as the Tags
+dictionaries the worker processes used to hand back, and as the rename plan
+of the files.  The tagging instances of mutagen are measured over --sample
+files of a generated library, loading a million of them is not practical.
+Compare two results with compare.py.
+
+Options:
+  -n, --files=<n>     Number of files of the synthetic library
+                      [default: 1000000].
+  --sample=<n>        Number of generated files loaded with mutagen
+                      [default: 500].
+  --seed=<seed>       Seed of the random title sizes [default: 0].
+  -o, --output=<file> Write the results to <file> instead of stdout.
+"""
+
+from __future__ import print_function
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mutagen  # noqa
+import tagcli  # noqa
+from generate import ALBUMS, TRACKS, generate  # noqa
+from run import commit  # noqa
+
+
+def synthetic(count, seed=0):
+    """Yield (path, tags) for `count` files laid out like generate.py, each
+    value a new string as if it was read from the file."""
+    rand = random.Random(seed)
+    for i in xrange(count):
+        album, track = divmod(i, TRACKS)
+        artist, album = divmod(album, ALBUMS)
+        path = '/srv/music/artist-%03d/album-%03d/%02d%s' % (
+            artist, album, track + 1, ('.mp3', '.m4a')[i % 2])
+        yield path, {
+            'artist': [u'Artist %d' % artist],
+            'albumartist': [u'Artist %d' % artist],
+            'album': [u'Album %d of Artist %d' % (album, artist)],
+            'title': [u'Title %d ' % track + u'x' * int(
+                rand.expovariate(1.0 / 200))],
+            'tracknumber': [u'%d/%d' % (track + 1, TRACKS)],
+            'discnumber': [u'1'],
+        }
+
+
+def records(count, seed):
+    return [tagcli.TagRecord(path, tags, (4096, 1.0e9))
+            for path, tags in synthetic(count, seed)]
+
+
+def dicts(count, seed):
+    return [tagcli.Tags(tags) for _, tags in synthetic(count, seed)]
+
+
+def plan(count, seed):
+    pattern = tagcli.Pattern(u'{tracknumber:02} {artist} - {title}')
+    rows = []
+    for path, tags in synthetic(count, seed):
+        name = pattern.format(tagcli.SimpleDict(tagcli.TagRecord(path, tags)))
+        name = name.encode('utf-8') + os.path.splitext(path)[1]
+        rows.append((path, name, os.path.join(os.path.dirname(path), name),
+                     None))
+    return rows
+
+
+def loaded(files):
+    return [tagcli.load(f) for f in files]
+
+
+def resident():
+    """Return the resident memory of the process, in bytes."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # the peak, in kilobytes on Linux but in bytes on OS X.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _measure(func, args, results):
+    before = resident()
+    kept = func(*args)
+    results.put((resident() - before) / len(kept))
+
+
+def measure(func, *args):
+    """Return the bytes per item of the list returned by func(*args), built
+    in a fresh process."""
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure,
+                                      args=(func, args, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main(argv=None):
+    args = docopt(__doc__, argv=argv)
+    count, sample = int(args['--files']), int(args['--sample'])
+    seed = int(args['--seed'])
+
+    top = tempfile.mkdtemp(prefix='tagcli-bench-')
+    try:
+        sizes = {'mutagen': measure(loaded, generate(top, sample, seed))}
+    finally:
+        shutil.rmtree(top)
+    sizes.update({
+        'TagRecord': measure(records, count, seed),
+        'Tags': measure(dicts, count, seed),
+        'rename plan': measure(plan, count, seed),
+    })
+
+    results = {
+        'meta': {
+            'tagcli': tagcli.__version__,
+            'commit': commit(),
+            'python': platform.python_version(),
+            'mutagen': mutagen.version_string,
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'files': count,
+            'sample': sample,
+        },
+        'bytes_per_file': sizes,
+    }
+    output = open(args['--output'], 'w') if args['--output'] else sys.stdout
+    json.dump(results, output, indent=2, sort_keys=True,
+              separators=(',', ': '))
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
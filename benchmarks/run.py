@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time tagcli over a synthetic library and emit the results as JSON.
+
+Usage:
+  run.py [options]
+
+The end to end timings run the dump, rename --dry-run, update, update
+with --rename and dupes commands over the whole library, and the dump once
+more served from the tag index.  The phase timings run load(), the
+formatting of the tags and save() file by file.  Each timing is the best
+of --repeat runs, in seconds.  Compare two results with compare.py.
+
+With --cold, the files of the library are dropped from the page cache before
+each run of the commands, and the dump is also timed in the inode and
+physical I/O orders with read ahead, see 'tag help dump'.
+
+Options:
+  -n, --files=<n>     Number of files of the library [default: 1000].
+  -j, --jobs=<n>      Number of workers of the commands [default: 1].
+  --repeat=<n>        Number of runs of each timing [default: 3].
+  --library=<dir>     Generate the library in <dir> and keep it, instead of
+                      a temporary directory.
+  --cold              Time the commands with a cold page cache.
+  -o, --output=<file> Write the results to <file> instead of stdout.
+"""
+
+from __future__ import print_function
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from contextlib import contextmanager
+from functools import partial
+from timeit import default_timer
+
+from docopt import docopt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mutagen  # noqa
+import tagcli  # noqa
+from generate import generate  # noqa
+
+
+@contextmanager
+def silenced():
+    """Discard the output of the commands."""
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout, sys.stderr = stdout, stderr
+
+
+POSIX_FADV_DONTNEED = 4
+
+
+def evict(files):
+    """Drop the `files` from the page cache, without privileges."""
+    fadvise = tagcli._fadvise()
+    if fadvise is None:
+        sys.exit('--cold needs posix_fadvise()')
+    for f in files:
+        fd = os.open(f, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            fadvise(fd, 0, 0, POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def best(func, repeat, setup=None):
+    """Return the best wall time of `repeat` calls of func(run), each one
+    after an untimed call of setup()."""
+    timings = []
+    for run in range(repeat):
+        if setup is not None:
+            setup()
+        start = default_timer()
+        func(run)
+        timings.append(default_timer() - start)
+    return min(timings)
+
+
+def commands(top, jobs, repeat, files=None):
+    """Time the commands end to end, with a cold page cache if the `files`
+    of the library are given."""
+    def command(*argv, **kwargs):
+        def run(n):
+            with silenced():
+                tagcli.main([arg.replace('{n}', str(n)) for arg in argv])
+        if kwargs.get('warm'):
+            run(-1)
+        return best(run, repeat, files and partial(evict, files))
+
+    jobs = '--jobs=%d' % jobs
+    timings = {}
+    if files:
+        for order in ('inode', 'physical'):
+            timings['dump --io-order=%s --readahead=16' % order] = command(
+                'dump', jobs, '--io-order=' + order, '--readahead=16',
+                '--recursive', top)
+    timings.update({
+        'dump': command('dump', jobs, '--recursive', top),
+        'dump --fast': command('dump', jobs, '--fast', '--recursive', top),
+        'dump --format=ndjson': command('dump', jobs, '--format=ndjson',
+                                        '--fields=artist,album,tracknumber',
+                                        '--recursive', top),
+        'rename --dry-run': command('rename', '--dry-run', '--recursive', top,
+                                    '{tracknumber:02} {artist} - {title}'),
+        # the files are copies of two fixtures, all of them are hashed.
+        'dupes': command('dupes', jobs, '--recursive', top),
+        # a different album each run, or the files are left unchanged.
+        'update': command('update', jobs, '--album=Run {n}',
+                          '--recursive', top),
+        # the files keep the names of generate.py.
+        'update --rename': command('update', jobs, '--album=Rerun {n}',
+                                   '--rename={tracknumber:02}',
+                                   '--recursive', top),
+    })
+    # served from an index built by an untimed run.
+    index = tempfile.mkdtemp(prefix='tagcli-index-')
+    try:
+        timings['dump --index'] = command(
+            'dump', jobs, '--index=' + os.path.join(index, 'index.sqlite'),
+            '--recursive', top, warm=True)
+    finally:
+        shutil.rmtree(index)
+    return timings
+
+
+def phases(files, repeat):
+    """Time load(), the formatting of the tags and save() file by file."""
+    metas = []
+
+    def loading(run):
+        metas[:] = [tagcli.load(f) for f in files]
+
+    pattern = tagcli.Pattern(u'{tracknumber:02} {artist} - {title}')
+
+    def formatting(run):
+        for meta in metas:
+            meta.pprint()
+            pattern.format(tagcli.SimpleDict(meta))
+
+    def saving(run):
+        for f, meta in zip(files, metas):
+            meta['album'] = u'Phase %d' % run
+            tagcli.save(meta, f)
+
+    return {
+        'load': best(loading, repeat),
+        'format': best(formatting, repeat),
+        'save': best(saving, repeat),
+    }
+
+
+def commit():
+    try:
+        git = subprocess.Popen(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
+    except OSError:
+        return None
+    output = git.communicate()[0].strip()
+    return output if git.returncode == 0 else None
+
+
+def main(argv=None):
+    args = docopt(__doc__, argv=argv)
+    count, jobs = int(args['--files']), int(args['--jobs'])
+    repeat = int(args['--repeat'])
+
+    top = args['--library'] or tempfile.mkdtemp(prefix='tagcli-bench-')
+    try:
+        files = generate(top, count)
+        timings = commands(top, jobs, repeat,
+                           files if args['--cold'] else None)
+        timings.update(phases(files, repeat))
+    finally:
+        if not args['--library']:
+            shutil.rmtree(top)
+
+    results = {
+        'meta': {
+            'tagcli': tagcli.__version__,
+            'commit': commit(),
+            'python': platform.python_version(),
+            'mutagen': mutagen.version_string,
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'files': count,
+            'jobs': jobs,
+            'repeat': repeat,
+            'cold': args['--cold'],
+        },
+        'timings': timings,
+        'files_per_second': dict((name, count / seconds) for name, seconds
+                                 in timings.items() if seconds),
+    }
+    output = open(args['--output'], 'w') if args['--output'] else sys.stdout
+    json.dump(results, output, indent=2, sort_keys=True,
+              separators=(',', ': '))
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
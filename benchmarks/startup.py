@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time the start up of tagcli and emit the results as JSON.
+
+Usage:
+  startup.py [options]
+
+Each timing runs a fresh interpreter: importing tagcli, `tag --version`,
+`tag help` and `tag dump` of a single file, also through a `tag serve`
+server.  Each timing is the best of the --repeat runs, in seconds.
+Compare two results with compare.py.
+
+Options:
+  --repeat=<n>        Number of runs of each timing [default: 10].
+  -o, --output=<file> Write the results to <file> instead of stdout.
+"""
+
+from __future__ import print_function
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from timeit import default_timer
+
+from docopt import docopt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import mutagen  # noqa
+import tagcli  # noqa
+from generate import generate  # noqa
+from run import commit  # noqa
+
+
+def best(argv, repeat):
+    """Return the best wall time of `repeat` runs of the python `argv`."""
+    devnull = open(os.devnull, 'w')
+    timings = []
+    for _ in range(repeat):
+        start = default_timer()
+        subprocess.check_call([sys.executable] + argv, cwd=ROOT,
+                              stdout=devnull, stderr=devnull)
+        timings.append(default_timer() - start)
+    return min(timings)
+
+
+def main(argv=None):
+    args = docopt(__doc__, argv=argv)
+    repeat = int(args['--repeat'])
+
+    script = os.path.join(ROOT, 'tagcli.py')
+    top = tempfile.mkdtemp(prefix='tagcli-bench-')
+    try:
+        filename, = generate(top, 1)
+        timings = {
+            'python': best(['-c', 'pass'], repeat),
+            'import': best(['-c', 'import tagcli'], repeat),
+            'tag --version': best([script, '--version'], repeat),
+            'tag help': best([script, 'help'], repeat),
+            'tag dump': best([script, 'dump', filename], repeat),
+        }
+        socket = os.path.join(top, 'tag.sock')
+        server = subprocess.Popen([sys.executable, script, 'serve',
+                                   '--socket=%s' % socket])
+        try:
+            while not os.path.exists(socket):
+                time.sleep(0.01)
+            timings['tag --connect dump'] = best(
+                [script, '--connect=%s' % socket, 'dump', filename], repeat)
+        finally:
+            server.terminate()
+            server.wait()
+    finally:
+        shutil.rmtree(top)
+
+    results = {
+        'meta': {
+            'tagcli': tagcli.__version__,
+            'commit': commit(),
+            'python': platform.python_version(),
+            'mutagen': mutagen.version_string,
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'repeat': repeat,
+        },
+        'timings': timings,
+    }
+    output = open(args['--output'], 'w') if args['--output'] else sys.stdout
+    json.dump(results, output, indent=2, sort_keys=True,
+              separators=(',', ': '))
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -5,120 +5,2624 @@ from __future__ import print_function
 import sys
 import os.path
 import shutil
+import collections
+import errno
+import heapq
+import itertools
+import mmap
+import re
+import string
+import struct
 
-from functools import wraps
-from mutagen.easymp4 import EasyMP4
-from mutagen.easyid3 import EasyID3
-from docopt import docopt
+from contextlib import closing, contextmanager
+from functools import partial, wraps
+from timeit import default_timer
+
+# mutagen, docopt and the modules only needed by some of the commands are
+# imported where they are used, to keep the start up time low.
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 
 __version__ = '0.2.0'
 
-# the following text keys are registered for the sake of compatibility.
-for frameid, key in ({
-    "TPE2": "albumartist"
-}.items()):
-    EasyID3.RegisterTextKey(key, frameid)
 
+def _register_easyid3(EasyID3):
+    # the following text keys are registered for the sake of compatibility.
+    for frameid, key in ({
+        "TPE2": "albumartist"
+    }.items()):
+        EasyID3.RegisterTextKey(key, frameid)
+
+
+# the tagging classes by format, imported by load() on first use, followed
+# by the function setting them up.  A format is added with its tagging class
+# here, its extensions in EXTENSIONS and its signature in sniff().
+BACKENDS = {
+    'mp3': ('mutagen.easyid3', 'EasyID3', _register_easyid3),
+    'mp4': ('mutagen.easymp4', 'EasyMP4', None),
+    'flac': ('mutagen.flac', 'FLAC', None),
+    'vorbis': ('mutagen.oggvorbis', 'OggVorbis', None),
+    'opus': ('mutagen.oggopus', 'OggOpus', None),
+}
+_backends = {}
+
+
+def backend(format):
+    """Return the tagging class of the `format` files, importing it on first
+    use; KeyError is raised if there is none."""
+    try:
+        return _backends[format]
+    except KeyError:
+        module, name, setup = BACKENDS[format]
+        cls = getattr(__import__(module, fromlist=[name]), name)
+        if setup is not None:
+            setup(cls)
+        return _backends.setdefault(format, cls)
+
+
+class SimpleDict(object):
+    '''A compatible wrapper for EasyID3, EasyMP4 and the Vorbis comments.'''
+    def __init__(self, meta):
+        self.meta = meta
+
+    def __getattr__(self, name):
+        # delegate everything to the self.meta under the hood
+        return getattr(self.meta, name)
+
+    def __getitem__(self, name):
+        # special care for the tracknumber and discnumber
+        # both of them are rendered as index/total pair.
+        if name in self.meta:
+            if name in ('tracknumber', 'discnumber'):
+                return int(self.meta[name][0].split('/')[0])
+            return self.meta[name][0]
+        else:
+            # FUTURE: extend the tag support, for example: tracktotal
+            raise KeyError(name)
+
+
+# the formats by lower case extension: the files found by walk(), and the
+# format of the files sniff() cannot tell.
+EXTENSIONS = {
+    '.mp3': 'mp3',
+    '.m4a': 'mp4',
+    '.m4b': 'mp4',
+    '.mp4': 'mp4',
+    '.flac': 'flac',
+    '.ogg': 'vorbis',
+    '.oga': 'vorbis',
+    '.opus': 'opus',
+}
+
+
+class Pattern(object):
+    """A naming pattern in python string format syntax, parsed once and then
+    formatted with the tags of every file.  The pattern may name a path,
+    such as ``{albumartist}/{album}/{title}``; a path separator in a tag is
+    replaced with ``_``, so that the tags never make directories."""
+
+    formatter = string.Formatter()
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.parsed = list(self.formatter.parse(pattern))
+        # the names of the referenced tags, e.g. album for {album[0]}
+        self.fields = set(re.match(r'[^.[]*', name).group()
+                          for _, name, _, _ in self.parsed if name)
+
+    def format(self, meta):
+        """Format the pattern with the referenced tags of `meta`, a
+        SimpleDict; KeyError is raised if one is missing."""
+        with stats.phase('format'):
+            tags = dict((name, meta[name]) for name in self.fields)
+            result = []
+            for literal, name, spec, conversion in self.parsed:
+                result.append(literal)
+                if name is not None:
+                    value, _ = self.formatter.get_field(name, (), tags)
+                    value = self.formatter.convert_field(value, conversion)
+                    if '{' in spec:
+                        spec = spec.format(**tags)
+                    result.append(self._component(format(value, spec)))
+            return u''.join(result)
+
+    @staticmethod
+    def _component(value):
+        # a formatted tag stays within its path component: only the
+        # separators of the pattern make directories.
+        if value in (u'.', u'..'):
+            return u'_' * len(value)
+        for sep in filter(None, (os.sep, os.altsep)):
+            value = value.replace(sep, u'_')
+        return value
+
+
+class Query(object):
+    """A predicate over the tags of a file, such as
+    ``artist=~'Beatles' and tracknumber>10``, compiled once and then called
+    with the SimpleDict of every file.  See 'tag help find' for the syntax.
+
+    The tags are only looked up when a comparison needs them, and the `and`
+    and `or` operators short-circuit.  ValueError is raised by a malformed
+    query.
+    """
+
+    _token = re.compile(r"""\s*(?:
+        (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*") |
+        (?P<op>=~|!~|==|!=|<=|>=|=|<|>) |
+        (?P<paren>[()]) |
+        (?P<word>[^\s()'"=!<>~]+))""", re.VERBOSE)
+
+    def __init__(self, query):
+        self.query = query
+        self.fields = set()
+        self.tokens = self._tokenize(query)
+        self.predicate = self._or()
+        if self.tokens:
+            raise ValueError("unexpected '%s'" % self.tokens[0][1])
+        del self.tokens
+
+    def __call__(self, meta):
+        return self.predicate(meta)
+
+    # the compiled predicate is a closure, the query is compiled again when
+    # it is handed to a worker process.
+    def __getstate__(self):
+        return self.query
+
+    def __setstate__(self, query):
+        self.__init__(query)
+
+    def _tokenize(self, query):
+        tokens, pos = [], 0
+        query = query.rstrip()
+        while pos < len(query):
+            match = self._token.match(query, pos)
+            if match is None:
+                raise ValueError("unexpected '%s'" % query[pos:].lstrip())
+            kind = match.lastgroup
+            tokens.append((kind, match.group(kind)))
+            pos = match.end()
+        return tokens
+
+    def _next(self, kind=None, value=None):
+        if not self.tokens:
+            raise ValueError('unexpected end of query')
+        if (kind is not None and self.tokens[0][0] != kind or
+                value is not None and self.tokens[0][1] != value):
+            raise ValueError("unexpected '%s'" % self.tokens[0][1])
+        return self.tokens.pop(0)[1]
+
+    def _peek(self, value):
+        return bool(self.tokens) and self.tokens[0] == ('word', value)
+
+    def _or(self):
+        predicates = [self._and()]
+        while self._peek('or'):
+            self._next()
+            predicates.append(self._and())
+        if len(predicates) == 1:
+            return predicates[0]
+        return lambda meta: any(predicate(meta) for predicate in predicates)
+
+    def _and(self):
+        predicates = [self._not()]
+        while self._peek('and'):
+            self._next()
+            predicates.append(self._not())
+        if len(predicates) == 1:
+            return predicates[0]
+        return lambda meta: all(predicate(meta) for predicate in predicates)
+
+    def _not(self):
+        if self._peek('not'):
+            self._next()
+            predicate = self._not()
+            return lambda meta: not predicate(meta)
+        if self.tokens and self.tokens[0] == ('paren', '('):
+            self._next()
+            predicate = self._or()
+            self._next('paren', ')')
+            return predicate
+        return self._comparison()
+
+    def _comparison(self):
+        field = self._next('word')
+        op = self._next('op')
+        kind, operand = self.tokens[0] if self.tokens else (None, None)
+        operand = self._next()
+        if kind == 'string':
+            operand = re.sub(r'\\(.)', r'\1', operand[1:-1])
+        elif kind != 'word':
+            raise ValueError("unexpected '%s'" % operand)
+        self.fields.add(field)
+        test = self._test(op, operand)
+
+        def comparison(meta):
+            try:
+                value = meta[field]
+            except KeyError:  # a missing tag matches no comparison
+                return False
+            return test(value)
+        return comparison
+
+    @staticmethod
+    def _test(op, operand):
+        # the test of a tag value against the operand: a regular expression
+        # search, or a comparison, numeric if the operand is a number.
+        if op in ('=~', '!~'):
+            try:
+                search = re.compile(operand, re.UNICODE).search
+            except re.error as exc:
+                raise ValueError("invalid regular expression '%s': %s"
+                                 % (operand, exc))
+            if op == '=~':
+                return lambda value: search(unicode(value)) is not None
+            return lambda value: search(unicode(value)) is None
+        compare = {
+            '=': lambda a, b: a == b, '==': lambda a, b: a == b,
+            '!=': lambda a, b: a != b,
+            '<': lambda a, b: a < b, '<=': lambda a, b: a <= b,
+            '>': lambda a, b: a > b, '>=': lambda a, b: a >= b,
+        }[op]
+        try:
+            number = float(operand)
+        except ValueError:
+            return lambda value: compare(unicode(value), operand)
+
+        def numeric(value):
+            try:
+                value = float(unicode(value).split('/')[0])
+            except ValueError:  # a tag which is not a number
+                return op == '!='
+            return compare(value, number)
+        return numeric
+
+
+def save(meta, filename, padding=None):
+    """Save the tagging instance `meta` to `filename`.
+
+    The padding left by the previous tag is reused when the new one fits in,
+    otherwise the file is rewritten with `padding` bytes reserved for the
+    next time, or mutagen's default if it is None.  Return True if the tag
+    was written in place, False if the whole file was rewritten.
+    """
+    def policy(info):
+        if info.padding >= 0:
+            return info.padding
+        if padding is None:
+            return info.get_default_padding()
+        return padding
+
+    import mutagen
+    size = os.path.getsize(filename)
+    with stats.phase('save'):
+        # the padding policy is only supported since mutagen 1.33
+        if mutagen.version < (1, 33):
+            meta.save(filename)
+        else:
+            meta.save(filename, padding=policy)
+    return os.path.getsize(filename) == size
+
+
+# the functions copying in the kernel, looked up on first use.
+_kernel_copies = None
+
+
+def _copies():
+    # the functions copying up to `count` bytes from the file offset of
+    # `fd_in` to the one of `fd_out` in the kernel, copy_file_range() first,
+    # each returning the number of bytes copied or raising OSError.
+    global _kernel_copies
+    if _kernel_copies is not None:
+        return _kernel_copies
+    _kernel_copies = []
+    if hasattr(os, 'copy_file_range'):
+        _kernel_copies.append(os.copy_file_range)
+    if hasattr(os, 'sendfile'):
+        _kernel_copies.append(lambda fd_in, fd_out, count:
+                              os.sendfile(fd_out, fd_in, None, count))
+    if _kernel_copies or not sys.platform.startswith('linux'):
+        return _kernel_copies
+
+    import ctypes
+    import ctypes.util
+
+    def checked(func, arguments):
+        def call(fd_in, fd_out, count):
+            copied = func(*arguments(fd_in, fd_out, count))
+            if copied < 0:
+                code = ctypes.get_errno()
+                raise OSError(code, os.strerror(code))
+            return copied
+        return call
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return _kernel_copies
+    # copy_file_range() is only in glibc 2.27+.
+    func = getattr(libc, 'copy_file_range', None)
+    if func is not None:
+        func.restype = ctypes.c_ssize_t
+        func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                         ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+        _kernel_copies.append(checked(
+            func, lambda fd_in, fd_out, count:
+            (fd_in, None, fd_out, None, count, 0)))
+    func = getattr(libc, 'sendfile', None)
+    if func is not None:
+        func.restype = ctypes.c_ssize_t
+        func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                         ctypes.c_size_t]
+        _kernel_copies.append(checked(
+            func, lambda fd_in, fd_out, count: (fd_out, fd_in, None, count)))
+    return _kernel_copies
+
+
+# the errors of a kernel copy the file systems or the kernel do not support.
+_UNSUPPORTED = frozenset(getattr(errno, name) for name in (
+    'ENOSYS', 'EXDEV', 'EINVAL', 'EOPNOTSUPP', 'ENOTSUP')
+    if hasattr(errno, name))
+
+
+def copy(src, dst, chunk=1 << 30):
+    """Copy the content of `src` to `dst` in the kernel, without going
+    through the memory of the process, with copy_file_range() or else
+    sendfile(); fall back to reading and writing it where neither is
+    supported."""
+    fd_in = os.open(src, os.O_RDONLY)
+    try:
+        fd_out = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            for func in _copies():
+                try:
+                    while func(fd_in, fd_out, chunk):
+                        pass
+                    return
+                except OSError as exc:
+                    # the next one goes on from the offsets reached.
+                    if exc.errno not in _UNSUPPORTED:
+                        raise
+            while True:
+                data = os.read(fd_in, 1 << 20)
+                if not data:
+                    return
+                while data:
+                    data = data[os.write(fd_out, data):]
+        finally:
+            os.close(fd_out)
+    finally:
+        os.close(fd_in)
+
+
+def move(src, dst):
+    """Rename `src` to `dst`, copying it with copy() only if they are on
+    different file systems."""
+    with stats.phase('move'):
+        try:
+            os.rename(src, dst)
+        except OSError as exc:
+            if exc.errno != errno.EXDEV:
+                raise
+            try:
+                copy(src, dst)
+                shutil.copystat(src, dst)
+            except BaseException:
+                if os.path.lexists(dst):
+                    os.unlink(dst)
+                raise
+            os.unlink(src)
+
+
+def makedirs(path):
+    """Make the directory `path` and its missing parents, unless it already
+    exists."""
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+def conflicts(plan):
+    """Yield the problems of a rename `plan`, a list of (src, dst) pairs: the
+    targets claimed by more than one file, or already taken."""
+    claimed = {}
+    for src, dst in plan:
+        target = os.path.normcase(os.path.abspath(dst))
+        if target in claimed:
+            yield "'%s' and '%s' both rename to '%s'" % (claimed[target],
+                                                         src, dst)
+            continue
+        claimed[target] = src
+        if os.path.lexists(dst) and not (os.path.exists(src) and
+                                         os.path.samefile(src, dst)):
+            yield "'%s' renames to '%s' which already exists" % (src, dst)
+
+
+def sniff(fileobj):
+    """Return the format of the file read from `fileobj` by its first bytes,
+    or None if they are not known."""
+    head = fileobj.read(64)
+    if head[:3] == 'ID3' and len(head) >= 10:
+        # an ID3v2 tag may be put before a FLAC stream too.
+        fileobj.seek(10 + _syncsafe(head[6:10]) +
+                     (10 if ord(head[5]) & 0x10 else 0))
+        return 'flac' if fileobj.read(4) == 'fLaC' else 'mp3'
+    elif head[4:8] == 'ftyp':
+        return 'mp4'
+    elif head[:4] == 'fLaC':
+        return 'flac'
+    elif head[:4] == 'OggS':
+        # the identification header is the first packet of the stream.
+        packet = head[27 + ord(head[26]):] if len(head) > 27 else ''
+        if packet.startswith('\x01vorbis'):
+            return 'vorbis'
+        elif packet.startswith('OpusHead'):
+            return 'opus'
+    elif len(head) >= 2 and head[0] == '\xff' and ord(head[1]) & 0xe0 == 0xe0:
+        return 'mp3'  # the sync of an MPEG audio frame without ID3v2 tag
+    return None
+
+
+def load(filename):
+    """Return a tagging instance, of the format sniffed from the content of
+    `filename`, or else told by its extension."""
+    _, ext = os.path.splitext(filename)
+    with stats.phase('load'):
+        try:
+            with open(filename, 'rb') as fileobj:
+                format = sniff(fileobj)
+        except (IOError, _Unsupported, struct.error):
+            # left to the backend to report, if the extension is known: the
+            # file cannot be read, or its ID3v2 header is malformed.
+            format = None
+        format = format or EXTENSIONS.get(ext.lower())
+        if format is None:
+            raise NotImplementedError('unknown extension: %s' % ext)
+        return backend(format)(filename)
+
+
+# the tags listed in 'tag help tags', the only ones decoded by scan().
+TAG_KEYS = ('artist', 'albumartist', 'album', 'title', 'discnumber',
+            'tracknumber')
+
+
+class Tags(dict):
+    """The tags of a file as lists of values keyed by tag name, in place of
+    a tagging instance when the file is only read."""
+    def __init__(self, tags, text=None):
+        super(Tags, self).__init__(tags)
+        self.text = text
+
+    def pprint(self):
+        if self.text is not None:
+            return self.text
+        return '\n'.join('%s=%s' % (key, value)
+                         for key in sorted(self) for value in self[key])
+
+
+# the values of these tags are held once by the TagRecord instances, as
+# interned strings freed with the last record holding them; the titles are
+# seldom shared.  The sets of tag names are held once too, up to a bound.
+_SHARED_KEYS = frozenset(TAG_KEYS) - frozenset(['title'])
+_keysets = {}
+_KEYSETS_SIZE = 1024
+
+
+def _compact(key, values):
+    # the values of a tag UTF-8 encoded, a quarter of the size of unicode
+    # strings, and a single value on its own.
+    shared = key in _SHARED_KEYS
+    compact = []
+    for value in values:
+        value = (value.encode('utf-8') if isinstance(value, unicode)
+                 else str(value))
+        compact.append(intern(value) if shared else value)
+    return compact[0] if len(compact) == 1 else tuple(compact)
+
+
+class TagRecord(object):
+    """The tags of a file once it is read, with its path, size and
+    modification time: the compact stand-in for the tagging instance that
+    the library keeps.  It reads like Tags, as lists of unicode values
+    keyed by tag name."""
+
+    __slots__ = ('path', 'size', 'mtime', '_keys', '_values')
+
+    def __init__(self, path, tags, stamp=None):
+        self.path = path
+        self.size, self.mtime = stamp or (None, None)
+        keys = tuple(sorted(tags.keys()))
+        if keys in _keysets or len(_keysets) < _KEYSETS_SIZE:
+            keys = _keysets.setdefault(keys, keys)
+        self._keys = keys
+        self._values = tuple(_compact(key, tags[key]) for key in keys)
+
+    def __reduce__(self):
+        # rebuilt by __init__, to share the values in the receiving process.
+        return TagRecord, (self.path, dict(self.items()), self.stamp)
+
+    @property
+    def stamp(self):
+        """The size and modification time of the file, None if unknown."""
+        return None if self.size is None else (self.size, self.mtime)
+
+    def __getitem__(self, key):
+        try:
+            values = self._values[self._keys.index(key)]
+        except ValueError:
+            raise KeyError(key)
+        if not isinstance(values, tuple):
+            return [values.decode('utf-8', 'replace')]
+        return [value.decode('utf-8', 'replace') for value in values]
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return 'TagRecord(%r, %r)' % (self.path, dict(self.items()))
+
+    def get(self, key, default=None):
+        return self[key] if key in self._keys else default
+
+    def keys(self):
+        return list(self._keys)
+
+    def items(self):
+        return [(key, self[key]) for key in self._keys]
+
+    def pprint(self):
+        return '\n'.join('%s=%s' % (key, value)
+                         for key in self._keys for value in self[key])
+
+
+class _Unsupported(Exception):
+    """Raised by the header-only readers to fall back to load()."""
+
+
+_ID3_FRAMES = {
+    'artist': ('TPE1', 'TP1'),
+    'albumartist': ('TPE2', 'TP2'),
+    'album': ('TALB', 'TAL'),
+    'title': ('TIT2', 'TT2'),
+    'discnumber': ('TPOS', 'TPA'),
+    'tracknumber': ('TRCK', 'TRK'),
+}
+
+
+def _syncsafe(data):
+    a, b, c, d = struct.unpack('>4B', data)
+    if (a | b | c | d) & 0x80:
+        raise _Unsupported('invalid synchsafe integer')
+    return a << 21 | b << 14 | c << 7 | d
+
+
+def _id3_text(data):
+    # the text frames hold a list of strings, each of them terminated,
+    # except the last one, by a null character of the given encoding.
+    encoding, data = ord(data[0]), data[1:]
+    if encoding in (1, 2):
+        codec = 'utf-16' if encoding == 1 else 'utf-16-be'
+        values, start = [], 0
+        for pos in range(0, len(data) - 1, 2):
+            if data[pos:pos + 2] == '\x00\x00':
+                values.append(data[start:pos])
+                start = pos + 2
+        values.append(data[start:])
+    elif encoding in (0, 3):
+        codec = 'latin1' if encoding == 0 else 'utf-8'
+        values = data.split('\x00')
+    else:
+        raise _Unsupported('unknown text encoding %d' % encoding)
+    if values and not values[-1]:
+        values.pop()
+    return [value.decode(codec) for value in values]
+
+
+def _scan_id3(buf, keys):
+    """Decode the `keys` from the ID3v2 tag, or the ID3v1 one if there is
+    no ID3v2 tag, just like EasyID3."""
+    if buf[:3] != 'ID3':
+        return _scan_id3v1(buf[-128:], keys)
+    version, _, flags = struct.unpack('>3B', buf[3:6])
+    if version not in (2, 3, 4) or version == 2 and flags & 0x40:
+        raise _Unsupported('ID3v2.%d with flags %x' % (version, flags))
+    data = buf[10:10 + _syncsafe(buf[6:10])]
+    if version < 4 and flags & 0x80:
+        data = data.replace('\xff\x00', '\xff')
+    if flags & 0x40 and version == 3:
+        data = data[4 + struct.unpack('>I', data[:4])[0]:]
+    elif flags & 0x40 and version == 4:
+        data = data[_syncsafe(data[:4]):]
+
+    wanted = dict((_ID3_FRAMES[key][version == 2], key) for key in keys)
+    tags = {}
+    pos = 0
+    while pos < len(data):
+        if version == 2:
+            frameid, size = data[pos:pos + 3], data[pos + 3:pos + 6]
+            if len(size) < 3:
+                break
+            size = struct.unpack('>I', '\x00' + size)[0]
+            flags, pos = 0, pos + 6
+        else:
+            frameid, size = data[pos:pos + 4], data[pos + 4:pos + 8]
+            if len(size) < 4:
+                break
+            if version == 4:
+                size = _syncsafe(size)
+            else:
+                size = struct.unpack('>I', size)[0]
+            flags = struct.unpack('>H', data[pos + 8:pos + 10])[0]
+            pos += 10
+        if frameid.strip('\x00') == '':
+            break  # padding
+        if not frameid.isalnum() or frameid.upper() != frameid:
+            raise _Unsupported('invalid frame %r' % frameid)
+        framedata, pos = data[pos:pos + size], pos + size
+        if frameid not in wanted or not size:
+            continue
+        if version == 3 and flags & 0x00e0 or version == 4 and flags & 0x004c:
+            raise _Unsupported('compressed, encrypted or grouped frame')
+        if version == 4 and flags & 0x0002:
+            framedata = framedata.replace('\xff\x00', '\xff')
+        if version == 4 and flags & 0x0001:
+            framedata = framedata[4:]
+        tags[wanted[frameid]] = _id3_text(framedata)
+    return Tags(tags)
+
+
+def _scan_id3v1(data, keys):
+    if len(data) < 128 or data[:3] != 'TAG':
+        raise _Unsupported('no ID3 tag')
+
+    def text(start, end):
+        return data[start:end].split('\x00')[0].strip().decode('latin1')
+
+    tags = {}
+    for key, start, end in (('title', 3, 33), ('artist', 33, 63),
+                            ('album', 63, 93)):
+        if key in keys and text(start, end):
+            tags[key] = [text(start, end)]
+    # a null before the last byte of the comment makes it ID3v1.1.
+    if 'tracknumber' in keys and data[125] == '\x00' and data[126] != '\x00':
+        tags['tracknumber'] = [unicode(ord(data[126]))]
+    return Tags(tags)
+
+
+_MP4_ATOMS = {
+    'artist': '\xa9ART',
+    'albumartist': 'aART',
+    'album': '\xa9alb',
+    'title': '\xa9nam',
+    'discnumber': 'disk',
+    'tracknumber': 'trkn',
+}
+
+
+def _mp4_atoms(buf, start, end):
+    """Yield the (name, start, end) of the data of the atoms in
+    buf[start:end]."""
+    while start + 8 <= end:
+        size, name = struct.unpack('>I4s', buf[start:start + 8])
+        offset = 8
+        if size == 1:
+            size = struct.unpack('>Q', buf[start + 8:start + 16])[0]
+            offset = 16
+        elif size == 0:
+            size = end - start
+        if size < offset or start + size > end:
+            raise _Unsupported('truncated %r atom' % name)
+        yield name, start + offset, start + size
+        start += size
+
+
+def _mp4_child(buf, start, end, name):
+    for child, child_start, child_end in _mp4_atoms(buf, start, end):
+        if child == name:
+            return child_start, child_end
+    raise KeyError(name)
+
+
+def _scan_mp4(buf, keys):
+    """Decode the `keys` from the moov.udta.meta.ilst atom, just like
+    EasyMP4, without walking the rest of the atom tree."""
+    try:
+        start, end = _mp4_child(buf, 0, len(buf), 'moov')
+    except KeyError:
+        raise _Unsupported('no moov atom')
+    try:
+        start, end = _mp4_child(buf, start, end, 'udta')
+        start, end = _mp4_child(buf, start, end, 'meta')
+        # meta is a full atom, skip the version and flags.
+        start, end = _mp4_child(buf, start + 4, end, 'ilst')
+    except KeyError:
+        return Tags({})
+
+    wanted = dict((_MP4_ATOMS[key], key) for key in keys)
+    tags = {}
+    for name, start, end in _mp4_atoms(buf, start, end):
+        if name not in wanted:
+            continue
+        values = []
+        for child, data_start, data_end in _mp4_atoms(buf, start, end):
+            if child != 'data':
+                raise _Unsupported('unexpected %r atom in %r' % (child, name))
+            flags = struct.unpack('>I', buf[data_start:data_start + 4])[0]
+            data = buf[data_start + 8:data_end]
+            if name in ('trkn', 'disk'):
+                index, total = struct.unpack('>2H', data[2:6])
+                values.append(u'%d/%d' % (index, total) if total
+                              else unicode(index))
+            elif flags == 1:
+                values.append(data.decode('utf-8', 'replace'))
+        if values:
+            tags[wanted[name]] = values
+    return Tags(tags)
+
+
+# the header-only readers by format, see sniff().
+_SCANNERS = {
+    'mp3': _scan_id3,
+    'mp4': _scan_mp4,
+}
+
+
+def scan(filename, keys=TAG_KEYS):
+    """Return the tags of `filename` for reading only, decoding just the
+    `keys` straight from the memory-mapped tag headers.
+
+    Only the tags in 'tag help tags' can be scanned, the file is loaded
+    instead if other `keys` are asked for, or if the headers use a feature
+    the scanner does not handle.
+    """
+    if not set(keys) <= set(TAG_KEYS):
+        return load(filename)
+    try:
+        with open(filename, 'rb') as fileobj:
+            buf = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, ValueError):  # missing or empty file
+        return load(filename)
+    try:
+        with stats.phase('scan'):
+            scanner = _SCANNERS.get(sniff(buf))
+            if scanner is not None:
+                return scanner(buf, keys)
+        return load(filename)
+    except (_Unsupported, struct.error, IndexError, UnicodeError):
+        return load(filename)
+    finally:
+        buf.close()
+
+
+def _id3v2_end(buf, start=0):
+    # the offset following the ID3v2 tags at `start`, with their footers.
+    while buf[start:start + 3] == 'ID3':
+        start += 10 + _syncsafe(buf[start + 6:start + 10]) + (
+            10 if ord(buf[start + 5]) & 0x10 else 0)
+    return start
+
+
+def _id3v1_start(buf, end):
+    return end - 128 if end >= 128 and buf[end - 128:end - 125] == 'TAG' \
+        else end
+
+
+def _payload_mp3(buf):
+    """The MPEG audio frames, between the ID3v2 and ID3v1 tags."""
+    start = _id3v2_end(buf)
+    return [(start, _id3v1_start(buf, len(buf)))]
+
+
+def _payload_mp4(buf):
+    """The data of the mdat atoms, the tags being in the moov atom."""
+    ranges = [(start, end) for name, start, end
+              in _mp4_atoms(buf, 0, len(buf)) if name == 'mdat']
+    if not ranges:
+        raise _Unsupported('no mdat atom')
+    return ranges
+
+
+def _payload_flac(buf):
+    """The FLAC frames, after the metadata blocks."""
+    start = _id3v2_end(buf)
+    if buf[start:start + 4] != 'fLaC':
+        raise _Unsupported('no FLAC stream')
+    start += 4
+    last = False
+    while not last:
+        header, = struct.unpack('>I', buf[start:start + 4])
+        last = header & 0x80000000
+        start += 4 + (header & 0xffffff)
+    return [(start, _id3v1_start(buf, len(buf)))]
+
+
+def _payload_ogg(buf):
+    """The bodies of the Ogg pages of the audio packets, without the page
+    headers which number the pages after the comment packet."""
+    ranges, pos, headers = [], 0, True
+    while pos + 27 <= len(buf):
+        if buf[pos:pos + 4] != 'OggS':
+            raise _Unsupported('lost the Ogg page sync at %d' % pos)
+        granule, = struct.unpack('<q', buf[pos + 6:pos + 14])
+        start = pos + 27 + ord(buf[pos + 26])
+        end = start + sum(bytearray(buf[pos + 27:start]))
+        # the header packets end on a page of granule position 0, the
+        # pages they span end no packet, -1.
+        headers = headers and granule in (0, -1)
+        if not headers:
+            ranges.append((start, end))
+        pos = end
+    return ranges
+
+
+# the audio payload readers by format, see sniff().
+_PAYLOADS = {
+    'mp3': _payload_mp3,
+    'mp4': _payload_mp4,
+    'flac': _payload_flac,
+    'vorbis': _payload_ogg,
+    'opus': _payload_ogg,
+}
+
+
+def payload(buf):
+    """Return the (start, end) ranges of the audio payload in `buf`, the
+    content of a file, skipping its tags, so that the same audio has the
+    same payload whatever its tags.  NotImplementedError is raised for an
+    unknown format or a malformed file."""
+    buf.seek(0)
+    reader = _PAYLOADS.get(sniff(buf))
+    if reader is None:
+        raise NotImplementedError('unknown format')
+    try:
+        return reader(buf)
+    except (_Unsupported, struct.error, IndexError) as exc:
+        raise NotImplementedError('malformed file: %s' % exc)
+
+
+@contextmanager
+def _mapped(filename):
+    # the content of `filename`, memory-mapped for reading.
+    with open(filename, 'rb') as fileobj:
+        buf = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        yield buf
+    finally:
+        buf.close()
+
+
+def default_index_path():
+    """Return the location of the tag index, see 'tag help index'."""
+    if os.environ.get('TAGCLI_INDEX'):
+        return os.environ['TAGCLI_INDEX']
+    cache = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache, 'tagcli', 'index.sqlite')
+
+
+def _blob(path):
+    # the paths are stored as they are, whatever their encoding.
+    import sqlite3
+    return sqlite3.Binary(path)
+
+
+# the Index instances unpickled by this process, by path and pid.
+_indexes = {}
+
+
+def _shared_index(path):
+    # the Index at `path` of this process, the pid telling the instances
+    # inherited from the parent by a forked worker.
+    key = path, os.getpid()
+    if key not in _indexes:
+        _indexes[key] = Index(path)
+    return _indexes[key]
+
+
+class Index(object):
+    """An on-disk cache of the tags keyed by path, size and mtime.
+
+    The SQLite connection is opened lazily by each process and thread that
+    uses the index, so the instance can be shared with the workers.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS files (
+            path BLOB PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            tags TEXT NOT NULL,
+            text TEXT NOT NULL
+        )"""
+
+    def __init__(self, path):
+        import threading
+        self.path = path
+        self._local = threading.local()
+
+    def __reduce__(self):
+        # a worker is handed the index with each of its tasks: share one
+        # instance, and so its connections, among them.
+        return _shared_index, (self.path,)
+
+    @property
+    def db(self):
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            dirname = os.path.dirname(os.path.abspath(self.path))
+            if not os.path.isdir(dirname):
+                try:
+                    os.makedirs(dirname)
+                except OSError:
+                    # created by another worker in the meantime
+                    if not os.path.isdir(dirname):
+                        raise
+            import sqlite3
+            db = sqlite3.connect(self.path, timeout=60)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            with db:
+                db.execute(self.schema)
+            local.db, local.pid = db, os.getpid()
+        return local.db
+
+    @staticmethod
+    def key(filename):
+        """Return the (path, size, mtime_ns) key of `filename`."""
+        st = os.stat(filename)
+        mtime_ns = getattr(st, 'st_mtime_ns', None)
+        if mtime_ns is None:
+            mtime_ns = int(st.st_mtime * 10 ** 9)
+        return os.path.abspath(filename), st.st_size, mtime_ns
+
+    def lookup(self, key):
+        """Return the tags indexed under `key`, None if they are stale."""
+        path, size, mtime_ns = key
+        with stats.phase('index'):
+            row = self.db.execute(
+                'SELECT tags, text FROM files '
+                'WHERE path = ? AND size = ? AND mtime_ns = ?',
+                (_blob(path), size, mtime_ns)).fetchone()
+        if row is not None:
+            import json
+            return Tags(json.loads(row[0]), row[1])
+
+    def store(self, key, meta):
+        import json
+        path, size, mtime_ns = key
+        tags = json.dumps(dict((k, meta[k]) for k in meta.keys()))
+        with stats.phase('index'):
+            with self.db as db:
+                db.execute('INSERT OR REPLACE INTO files '
+                           'VALUES (?, ?, ?, ?, ?)',
+                           (_blob(path), size, mtime_ns, tags,
+                            meta.pprint()))
+
+    def put(self, filename, meta):
+        """Index the tags of `filename`, e.g. after they are saved."""
+        self.store(self.key(filename), meta)
+
+    def read(self, filename, keys=None):
+        """Return the tags of `filename`, loading and indexing the file only
+        if it changed since it was last indexed.  If only the `keys` are
+        needed, the changed file is scanned instead, and not indexed."""
+        try:
+            key = self.key(filename)
+        except OSError:
+            return load(filename)
+        meta = self.lookup(key)
+        if meta is None:
+            if keys is not None:
+                return scan(filename, keys)
+            meta = load(filename)
+            self.store(key, meta)
+        return meta
+
+    def move(self, src, dst):
+        """Follow the rename of `src` to `dst`."""
+        with self.db as db:
+            db.execute('UPDATE OR REPLACE files SET path = ? WHERE path = ?',
+                       (_blob(os.path.abspath(dst)),
+                        _blob(os.path.abspath(src))))
+
+    def stamp(self, filename):
+        """Return the indexed (size, mtime_ns) of `filename`, if any."""
+        return self.db.execute(
+            'SELECT size, mtime_ns FROM files WHERE path = ?',
+            (_blob(os.path.abspath(filename)),)).fetchone()
+
+    def remove(self, path):
+        with self.db as db:
+            db.execute('DELETE FROM files WHERE path = ?',
+                       (_blob(path),))
+
+    def __iter__(self):
+        """Iterate over the indexed (path, size, mtime_ns) keys."""
+        for path, size, mtime_ns in self.db.execute(
+                'SELECT path, size, mtime_ns FROM files ORDER BY path'):
+            yield str(path), size, mtime_ns
+
+
+class Journal(object):
+    """A write-ahead journal of the renames and updates of a batch, so that
+    an interrupted batch can be resumed, or its renames undone.
+
+    The operations are appended to the file at `path`, each one as its name
+    and absolute paths, NUL-delimited and followed by a NUL and a newline:
+    the renames planned, before the first one is carried out, then each
+    rename, update or undone rename as it completes.  The records are
+    flushed as they are written, and synced to the disk once the plan is
+    written and when the journal is closed; the operations lost by a crash
+    of the system are found again from the files.  The journal is read back
+    if `resume` is set, otherwise it is started over on the first write.
+    """
+
+    def __init__(self, path, resume=False):
+        import threading
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+        # the files done, both the sources and targets of the renames, the
+        # renames done in order, and the renames planned but not done.
+        self.done = set()
+        self.renames = []
+        self.planned = {}
+        self.resume = resume
+        if resume and os.path.exists(path):
+            self._replay()
+
+    def _replay(self):
+        with open(self.path, 'rb') as f:
+            records = f.read().split('\x00\n')
+        # the last record is empty, or was cut short by a crash.
+        for record in records[:-1]:
+            op, paths = record.split('\x00', 1)
+            paths = paths.split('\x00')
+            if op == 'rename':
+                self.planned[paths[0]] = paths[1]
+            elif op == 'renamed':
+                self.planned.pop(paths[0], None)
+                self.renames.append(tuple(paths))
+                self.done.update(paths)
+            elif op == 'updated':
+                self.done.add(paths[0])
+            elif op == 'undone':
+                self.renames.remove(tuple(paths))
+                self.done.difference_update(paths)
+
+    def _write(self, *records):
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'ab' if self.resume else 'wb')
+            for record in records:
+                self.file.write('\x00'.join(record) + '\x00\n')
+            self.file.flush()
+
+    def __contains__(self, filename):
+        """Whether the operation of `filename` is done, or planned."""
+        path = os.path.abspath(filename)
+        return path in self.done or path in self.planned
+
+    def plan(self, moves):
+        """Log the renames planned, (src, dst) pairs, before the first one
+        is carried out."""
+        records = []
+        for src, dst in moves:
+            src, dst = os.path.abspath(src), os.path.abspath(dst)
+            self.planned[src] = dst
+            records.append(('rename', src, dst))
+        self._write(*records)
+        self.sync()
+
+    def renamed(self, src, dst):
+        src, dst = os.path.abspath(src), os.path.abspath(dst)
+        self._write(('renamed', src, dst))
+        with self.lock:
+            self.planned.pop(src, None)
+            self.renames.append((src, dst))
+            self.done.update((src, dst))
+
+    def updated(self, filename):
+        path = os.path.abspath(filename)
+        self._write(('updated', path))
+        with self.lock:
+            self.done.add(path)
+
+    def undone(self, src, dst):
+        self._write(('undone', src, dst))
+        with self.lock:
+            self.renames.remove((src, dst))
+            self.done.difference_update((src, dst))
+
+    def pending(self):
+        """Return the renames planned and not done, as (src, dst) pairs.
+        The ones found done in the file system are logged as done."""
+        pending = []
+        for src, dst in sorted(self.planned.items()):
+            if os.path.lexists(src):
+                pending.append((src, dst))
+            elif os.path.lexists(dst):
+                self.renamed(src, dst)
+        return pending
+
+    def sync(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+
+    def close(self):
+        self.sync()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def read(filename, index=None, keys=None):
+    """Return the tags of `filename` for reading only, served from the
+    `index` if the file did not change.  If only the `keys` are needed,
+    the file is scanned for them instead of being loaded."""
+    if index is not None:
+        return index.read(filename, keys)
+    return load(filename) if keys is None else scan(filename, keys)
+
+
+def _index(args):
+    path = args['--index'] or os.environ.get('TAGCLI_INDEX')
+    return Index(path) if path else None
+
+
+def _listdir(top):
+    # the names of the files and directories in `top`, sorted.
+    if scandir is not None:
+        return sorted((entry.name, entry.is_dir(follow_symlinks=False))
+                      for entry in scandir(top))
+    return sorted((name, os.path.isdir(os.path.join(top, name)) and
+                   not os.path.islink(os.path.join(top, name)))
+                  for name in os.listdir(top))
+
+
+def walk(top, onerror=None):
+    """Iterate over the audio files under the `top` directory, one directory
+    at a time, so that the first ones come before the whole tree is listed.
+    The `top` directory is listed at once, and its error raised; like
+    os.walk(), the subdirectories which cannot be listed are skipped, and
+    their error is handed to onerror() if given."""
+    return _walk(top, _listdir(top), onerror)
+
+
+def _walk(top, names, onerror):
+    for name, is_dir in names:
+        path = os.path.join(top, name)
+        if is_dir:
+            try:
+                listed = _listdir(path)
+            except EnvironmentError as exc:
+                if onerror is not None:
+                    onerror(exc)
+                continue
+            for path in _walk(path, listed, onerror):
+                yield path
+        elif os.path.splitext(name)[1].lower() in EXTENSIONS:
+            yield path
+
+
+def read_files(fileobj, bufsize=65536):
+    """Yield the NUL-delimited file names read from `fileobj`."""
+    pending = ''
+    for chunk in iter(partial(fileobj.read, bufsize), ''):
+        names = (pending + chunk).split('\x00')
+        pending = names.pop()
+        for name in names:
+            if name:
+                yield name
+    if pending:
+        yield pending
+
+
+# the FS_IOC_FIEMAP ioctl of Linux, and the layout of its struct fiemap
+# asking for the first extent of a file, and of the struct fiemap_extent.
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP = struct.Struct('=QQIIII')
+FIEMAP_EXTENT = struct.Struct('=QQQQQIIII')
+
+
+def _physical(path):
+    # the physical offset of the first extent of `path`, None if the file
+    # system does not tell it.
+    try:
+        import fcntl
+    except ImportError:
+        return None
+    request = (FIEMAP.pack(0, 0xffffffffffffffff, 0, 0, 1, 0) +
+               '\x00' * FIEMAP_EXTENT.size)
+    try:
+        with open(path, 'rb') as f:
+            reply = fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, request)
+    except (IOError, OSError):
+        return None
+    if not FIEMAP.unpack_from(reply)[3]:
+        return None
+    return FIEMAP_EXTENT.unpack_from(reply, FIEMAP.size)[1]
+
+
+IO_ORDERS = ('given', 'inode', 'physical')
+
+
+def order(files, how='given'):
+    """Return the `files` sorted in the order of their data on the disk, to
+    save the seeks of a hard disk: by device and inode number with 'inode',
+    and by the physical offset of their first extent with 'physical', where
+    the file system tells it (FIEMAP on Linux), or else by inode number.
+    The files are listed first, unless the order is 'given'."""
+    if how == 'given':
+        return files
+
+    def key(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return 0, 0, 0
+        physical = _physical(path) if how == 'physical' else None
+        return st.st_dev, physical or 0, st.st_ino
+
+    with stats.phase('order'):
+        return sorted(files, key=key)
+
+
+# posix_fadvise() of the C library, looked up on first use; None if it is
+# not available.
+POSIX_FADV_WILLNEED = 3
+_posix_fadvise = False
+
+
+def _fadvise():
+    global _posix_fadvise
+    if _posix_fadvise is False:
+        _posix_fadvise = getattr(os, 'posix_fadvise', None)
+        if _posix_fadvise is None:
+            import ctypes
+            import ctypes.util
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c'))
+                func = (getattr(libc, 'posix_fadvise64', None) or
+                        libc.posix_fadvise)
+            except (OSError, AttributeError):
+                return None
+            func.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                             ctypes.c_int]
+            _posix_fadvise = func
+    return _posix_fadvise
+
+
+def willneed(path, head=262144, tail=65536):
+    """Advise the kernel to read the first `head` and the last `tail` bytes
+    of `path` ahead, where the tags and the stream headers are, without
+    waiting for them; return False if the advice cannot be given."""
+    fadvise = _fadvise()
+    if fadvise is None:
+        return False
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        size = os.fstat(fd).st_size
+        fadvise(fd, 0, min(head, size), POSIX_FADV_WILLNEED)
+        if size > head:
+            offset = max(size - tail, head)
+            fadvise(fd, offset, size - offset, POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+    return True
+
+
+def readahead(files, depth):
+    """Yield the `files`, each one after the read ahead of the tags of the
+    `depth` next ones was started, see willneed()."""
+    ahead = collections.deque()
+    for f in files:
+        with stats.phase('readahead'):
+            willneed(f)
+        ahead.append(f)
+        if len(ahead) > depth:
+            yield ahead.popleft()
+    while ahead:
+        yield ahead.popleft()
+
+
+def _listed(fileobj):
+    # the files listed in `fileobj`, which is closed once they are all read.
+    with fileobj:
+        for f in read_files(fileobj):
+            yield f
+
+
+def _unlisted(exc):
+    # the directory found by --recursive which cannot be listed is skipped.
+    print('Skipping %s: %s' % (exc.filename, exc.strerror), file=sys.stderr)
+
+
+def shard_of(path, count):
+    """Return the shard of `path` among `count` shards, from 1 to `count`,
+    told by a stable hash of the path as given: the same on every host and
+    run, whatever the other files."""
+    import zlib
+    return (zlib.crc32(path) & 0xffffffff) % count + 1
+
+
+def _shard(args):
+    # the (index, count) of the --shard I/N of the command, if any.
+    if not args.get('--shard'):
+        return None
+    try:
+        index, count = map(int, args['--shard'].split('/'))
+    except ValueError:
+        index = count = 0
+    if not 1 <= index <= count:
+        sys.exit('--shard must be I/N, with 1 <= I <= N: %r'
+                 % args['--shard'])
+    return index, count
+
+
+def _files(args, sharded=True):
+    """Iterate lazily over the <files>, the files found under --recursive
+    and the ones read from --files-from, only the ones of the --shard if
+    `sharded`, in the --io-order and with the --readahead of the command if
+    it has them."""
+    if not (args['<files>'] or args['--recursive'] or args['--files-from'] or
+            args.get('--resume')):
+        from docopt import DocoptExit
+        raise DocoptExit()
+    files = [iter(args['<files>'])]
+    if args['--recursive']:
+        try:
+            files.append(walk(args['--recursive'], _unlisted))
+        except EnvironmentError as exc:
+            sys.exit('Cannot list --recursive %s: %s'
+                     % (args['--recursive'], exc.strerror))
+    if args['--files-from'] == '-':
+        files.append(read_files(sys.stdin))
+    elif args['--files-from']:
+        try:
+            files.append(_listed(open(args['--files-from'], 'rb')))
+        except EnvironmentError as exc:
+            sys.exit('Cannot read --files-from %s: %s'
+                     % (args['--files-from'], exc.strerror))
+    files = itertools.chain.from_iterable(files)
+    shard = _shard(args)
+    if shard is not None and sharded:
+        index, count = shard
+        files = (f for f in files if shard_of(f, count) == index)
+    if args.get('--io-order', 'given') not in IO_ORDERS:
+        sys.exit("%r is not an I/O order, it is one of %s." %
+                 (args['--io-order'], ', '.join(IO_ORDERS)))
+    files = order(files, args.get('--io-order', 'given'))
+    try:
+        depth = int(args.get('--readahead') or 0)
+    except ValueError:
+        exit('--readahead must be an integer: %r' % args['--readahead'])
+    return readahead(files, depth) if depth > 0 else files
+
+
+def _invoke(func, item, profiled=False):
+    # runs in the worker: exceptions are handed back as values, so the
+    # consumer never waits on a result that will not arrive.  The stats of a
+    # worker process are handed back too, to be merged by the consumer.
+    if profiled:
+        stats.start()
+    try:
+        result = True, func(item)
+    except Exception as exc:
+        result = False, exc
+    return result + (stats.stop() if profiled else None,)
+
+
+def pmap(func, iterable, jobs=1, ordered=True, threads=False):
+    """Yield func(item) for every item, spread across `jobs` workers.
+
+    Only a few tasks per worker are in flight at any time, so `iterable` is
+    consumed lazily.  The results are yielded in input order unless
+    `ordered` is false, in which case they come as soon as they are ready.
+    `func` must be picklable, i.e. a module level function, unless `threads`
+    is set.
+    """
+    if jobs <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+
+    import multiprocessing.pool
+    import Queue
+    pool = (multiprocessing.pool.ThreadPool if threads
+            else multiprocessing.Pool)(jobs)
+    done = Queue.Queue()
+    callback = None if ordered else done.put
+    pending = collections.deque()
+
+    def collect():
+        if ordered:
+            ok, value, profile = pending.popleft().get()
+        else:
+            pending.popleft()
+            ok, value, profile = done.get()
+        if profile is not None:
+            stats.merge(profile)
+        if not ok:
+            raise value
+        return value
+
+    # the threads share the stats of this process.
+    profiled = stats.enabled and not threads
+    try:
+        for item in iterable:
+            pending.append(pool.apply_async(_invoke, (func, item, profiled),
+                                            callback=callback))
+            if len(pending) >= jobs * 4:
+                yield collect()
+        while pending:
+            yield collect()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _jobs(args):
+    """Return the number of workers requested by --jobs."""
+    try:
+        n = int(args['--jobs'])
+    except ValueError:
+        exit('--jobs must be an integer: %r' % args['--jobs'])
+    if n > 0:
+        return n
+    import multiprocessing
+    return multiprocessing.cpu_count()
+
+
+class Summary(object):
+    """Tally of the per-file outcomes of a batch command."""
+
+    def __init__(self, statuses=('ok', 'skipped', 'failed')):
+        self.statuses = statuses
+        self.counts = dict.fromkeys(self.statuses, 0)
+        self.details = {}
+        self.failures = []
+
+    def add(self, filename, status, reason=None):
+        """Count the `status` of `filename`; the `reason` of a failure is
+        kept for the report, the one of a success is how it was done."""
+        self.counts[status] += 1
+        if status == 'failed':
+            self.failures.append((filename, reason))
+        elif status == 'ok' and reason:
+            self.details[reason] = self.details.get(reason, 0) + 1
+
+    @property
+    def status(self):
+        """The exit status of the command, non-zero if any file failed."""
+        return 1 if self.failures else 0
+
+    def report(self, out=None):
+        out = out or sys.stderr
+        counts = ['%d %s' % (self.counts[status], status)
+                  for status in self.statuses]
+        if self.details:
+            counts[0] += ' (%s)' % ', '.join(
+                '%d %s' % (count, detail)
+                for detail, count in sorted(self.details.items()))
+        print(', '.join(counts), file=out)
+        for filename, reason in self.failures:
+            print('  %s: %s' % (filename, reason), file=out)
+
+
+def _io_counters():
+    # the bytes read and written by this process so far, on Linux only.
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(':') for line in f)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (IOError, KeyError, ValueError):
+        return None
+
+
+class Stats(object):
+    """Wall time spent in each phase of a command, and by each file.
+
+    The phases are summed over the workers, so they may add up to more
+    than the wall time of the command.  The bytes are the ones read and
+    written by the processes as counted by the kernel, where available.
+    """
+
+    def __init__(self, slowest=10):
+        self.enabled = False
+        self.slowest = slowest
+        self.lock = None
+        self.reset()
+
+    def reset(self):
+        self.phases = {}
+        self.files = 0
+        self.bytes_read = self.bytes_written = 0
+        self.slowest_files = []
+        self.wall = 0.0
+
+    def start(self):
+        """Reset and enable the stats of this process."""
+        if self.lock is None:
+            import threading
+            self.lock = threading.Lock()
+        self.reset()
+        self.enabled = True
+        self._started = default_timer(), _io_counters()
+
+    def stop(self):
+        """Disable the stats of this process, and return them."""
+        started, counters = self._started
+        self.wall += default_timer() - started
+        if counters is not None:
+            self.bytes_read += _io_counters()[0] - counters[0]
+            self.bytes_written += _io_counters()[1] - counters[1]
+        self.enabled = False
+        return self.as_dict()
+
+    def add(self, name, seconds, count=1):
+        with self.lock:
+            phase = self.phases.setdefault(name, [0, 0.0])
+            phase[0] += count
+            phase[1] += seconds
+
+    def add_file(self, filename, seconds):
+        with self.lock:
+            self.files += 1
+            heapq.heappush(self.slowest_files, (seconds, filename))
+            if len(self.slowest_files) > self.slowest:
+                heapq.heappop(self.slowest_files)
+
+    @contextmanager
+    def phase(self, name):
+        """Time the body of the with statement as a `name` phase."""
+        if not self.enabled:
+            yield
+            return
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self.add(name, default_timer() - start)
+
+    @contextmanager
+    def file(self, filename):
+        """Time the body of the with statement as the work on `filename`."""
+        if not self.enabled:
+            yield
+            return
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self.add_file(filename, default_timer() - start)
+
+    def merge(self, other):
+        """Add the stats of a worker, as returned by as_dict()."""
+        for name, phase in other['phases'].items():
+            self.add(name, phase['seconds'], phase['count'])
+        for entry in other['slowest']:
+            self.add_file(entry['file'], entry['seconds'])
+        # add_file() counted the slowest files of the worker already.
+        self.files += other['files'] - len(other['slowest'])
+        self.bytes_read += other['bytes_read']
+        self.bytes_written += other['bytes_written']
+
+    def as_dict(self):
+        return {
+            'wall': self.wall,
+            'files': self.files,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'phases': dict((name, {'count': count, 'seconds': seconds})
+                           for name, (count, seconds) in self.phases.items()),
+            'slowest': [{'file': filename, 'seconds': seconds}
+                        for seconds, filename
+                        in sorted(self.slowest_files, reverse=True)],
+        }
+
+    def report(self, out=None):
+        out = out or sys.stderr
+        print('%.3fs wall time, %d files, %d bytes read, %d bytes written' % (
+            self.wall, self.files, self.bytes_read, self.bytes_written),
+            file=out)
+        for name, (count, seconds) in sorted(self.phases.items(),
+                                             key=lambda item: -item[1][1]):
+            print('  %-10s %10.3fs %8d calls' % (name, seconds, count),
+                  file=out)
+        if self.slowest_files:
+            print('slowest files:', file=out)
+        for seconds, filename in sorted(self.slowest_files, reverse=True):
+            print('  %10.3fs %s' % (seconds, filename), file=out)
+
+
+# the stats of the running command, see 'tag help' for --profile.
+stats = Stats()
+
+
+class LRUCache(object):
+    """A mapping of the `size` most recently used items, safe to share
+    between threads."""
+
+    def __init__(self, size):
+        import threading
+        self.size = size
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        # the items are linked from the least to the most recently used one
+        # in a circular list of [previous, next, key, value] links.
+        with self.lock:
+            self.links = {}
+            self.root = []
+            self.root[:] = [self.root, self.root, None, None]
+
+    def __len__(self):
+        return len(self.links)
+
+    def _unlink(self, link):
+        previous, next = link[0], link[1]
+        previous[1], next[0] = next, previous
+
+    def _append(self, link):
+        last = self.root[0]
+        link[0], link[1] = last, self.root
+        last[1] = self.root[0] = link
+
+    def get(self, key, default=None):
+        with self.lock:
+            link = self.links.get(key)
+            if link is None:
+                return default
+            self._unlink(link)
+            self._append(link)
+            return link[3]
+
+    def put(self, key, value):
+        with self.lock:
+            link = self.links.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+            elif len(self.links) >= self.size:
+                oldest = self.root[1]
+                if oldest is self.root:  # a size of 0
+                    return
+                self._unlink(oldest)
+                del self.links[oldest[2]]
+            link = [None, None, key, value]
+            self._append(link)
+            self.links[key] = link
+
+    def pop(self, key, default=None):
+        with self.lock:
+            link = self.links.pop(key, None)
+            if link is None:
+                return default
+            self._unlink(link)
+            return link[3]
+
+
+def _stamp(path):
+    # the size and modification time of `path`, None if it is gone.
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime
+
+
+def _unreadable():
+    # the errors of a file which is skipped rather than read: an unknown
+    # format, an I/O error, or a malformed or untagged file, told by the
+    # IOError and ValueError subclasses of mutagen, or MutagenError.
+    import mutagen
+    error = getattr(mutagen, 'MutagenError', None)
+    return (NotImplementedError, EnvironmentError, ValueError) + (
+        (error,) if error is not None else ())
+
+
+def _reason(exc):
+    # the reason of a file skipped by one of the _unreadable() errors.
+    return exc.message if isinstance(exc, NotImplementedError) else str(exc)
+
+
+def _read(filename, index=None, keys=None, convert=None):
+    # runs in a worker process of Library.read_many().
+    with stats.file(filename):
+        stamp = _stamp(filename)
+        try:
+            meta = read(filename, index, keys)
+        except _unreadable() as exc:
+            return filename, None, _reason(exc)
+        if convert is not None:
+            return filename, convert(filename, meta), None
+        return filename, TagRecord(filename, meta, stamp), None
+
+
+def _duration(filename, format, start):
+    # the duration of the audio of `filename` in seconds, told by the stream
+    # headers at `start` for an MP3 file, which EasyID3 does not read.
+    if format != 'mp3':
+        return load(filename).info.length
+    from mutagen.mp3 import MPEGInfo
+    with stats.phase('load'):
+        with open(filename, 'rb') as fileobj:
+            return MPEGInfo(fileobj, start).length
+
+
+def _measure(filename):
+    # runs in a worker process of Library.find_dupes(): the format of
+    # `filename`, the size of its audio payload and its duration, or the
+    # reason to skip it.
+    with stats.file(filename):
+        try:
+            with _mapped(filename) as buf:
+                ranges = payload(buf)
+                buf.seek(0)
+                format = sniff(buf)
+            size = sum(end - start for start, end in ranges)
+            if not size:
+                return filename, None, None, None, 'no audio payload'
+            duration = _duration(filename, format, ranges[0][0])
+        except NotImplementedError as exc:
+            return filename, None, None, None, exc.message
+        except Exception as exc:
+            return filename, None, None, None, str(exc)
+        return filename, format, size, duration, None
+
+
+def _digest(filename, chunk=1 << 20):
+    # runs in a worker process of Library.find_dupes(): the SHA-1 of the
+    # audio payload of `filename`, or the reason to skip.
+    import hashlib
+    with stats.file(filename):
+        digest = hashlib.sha1()
+        try:
+            with _mapped(filename) as buf:
+                ranges = payload(buf)
+                with stats.phase('hash'):
+                    for start, end in ranges:
+                        for pos in xrange(start, end, chunk):
+                            digest.update(buf[pos:min(pos + chunk, end)])
+        except NotImplementedError as exc:
+            return filename, None, exc.message
+        except Exception as exc:
+            return filename, None, str(exc)
+        return filename, digest.hexdigest(), None
+
+
+def _step(filename, meta, pattern, dest=None):
+    # the step of the rename plan of `filename` to the name formatted by the
+    # `pattern` with its tags `meta`, under the `dest` directory or else its
+    # own, or with the reason of the problem and no name if a tag of the
+    # pattern is missing.
+    encoding = sys.getfilesystemencoding() or 'utf-8'
+    _, ext = os.path.splitext(filename)
+    try:
+        name = pattern.format(SimpleDict(meta)) + ext.decode(encoding)
+    except KeyError as exc:
+        return filename, None, None, "'%s' has no %s tag" % (filename,
+                                                             exc.args[0])
+    directory = os.path.dirname(filename) if dest is None else dest
+    return filename, name, os.path.join(directory, name.encode(encoding)), None
+
+
+def _has(meta, tags):
+    # whether `meta` already has the `tags` of an update.
+    return all(k in meta and meta[k] == _values(v) for k, v in tags.items())
+
+
+class Library(object):
+    """The batch operations of the commands, on any iterable of files, with
+    their results handed back instead of printed.
+
+    The tags are served from the tag `index` if given, otherwise read with
+    `jobs` workers, and handed back as TagRecord.  The records of the files
+    read and updated are kept in a cache of the `cache_size` most recently
+    used files, keyed by their path as given and checked against their size
+    and modification time, and shared by the operations of the library; a
+    `cache_size` of 0 disables it.  `padding` is the padding of the
+    rewritten files, see save().  The renames and updates are logged to the
+    `journal` if given, see Journal.
+    """
+
+    def __init__(self, index=None, jobs=1, cache_size=1024, padding=None,
+                 journal=None):
+        self.index = index
+        self.jobs = jobs
+        self.padding = padding
+        self.cache = LRUCache(cache_size)
+        self.journal = journal
+
+    def _cached(self, filename, keys=None):
+        # the cached tags of the unchanged `filename`, if they have the
+        # `keys`, or all the tags if None.
+        entry = self.cache.get(filename)
+        if entry is None:
+            return None
+        record, cached_keys = entry
+        if record.stamp != _stamp(filename) or cached_keys is not None and (
+                keys is None or not set(keys) <= cached_keys):
+            return None
+        return record
+
+    def _cache(self, record, keys=None):
+        if self.cache.size and record.stamp is not None:
+            self.cache.put(record.path,
+                           (record, None if keys is None else set(keys)))
+
+    def _keep(self, filename, meta):
+        # caches the record of the tagging instance of `filename`, it is
+        # not worth building otherwise.
+        if self.cache.size:
+            self._cache(TagRecord(filename, meta, _stamp(filename)))
+
+    def read(self, filename, keys=None):
+        """Return the TagRecord of `filename`, with only the `keys` if they
+        are given, see read(); NotImplementedError is raised for an unknown
+        format."""
+        record = self._cached(filename, keys)
+        if record is None:
+            stamp = _stamp(filename)
+            record = TagRecord(filename, read(filename, self.index, keys),
+                               stamp)
+            self._cache(record, keys)
+        return record
+
+    def read_many(self, files, keys=None, ordered=True, convert=None):
+        """Yield (file, tags, reason) for each of the `files` as they are
+        read, in order unless `ordered` is false; the tags are None and the
+        reason is given if the file is skipped.
+
+        With several jobs, the files are read by the worker processes and
+        their records cached for the next calls.  If `convert` is given,
+        convert(file, tags) of the tags as read is yielded instead of the
+        record, computed by the workers, and the cache is not used; it must
+        be a module level function to be handed to them.
+        """
+        if self.jobs <= 1 and convert is None:
+            for f in files:
+                with stats.file(f):
+                    try:
+                        result = f, self.read(f, keys), None
+                    except _unreadable() as exc:
+                        result = f, None, _reason(exc)
+                yield result
+            return
+        for f, record, reason in pmap(partial(_read, index=self.index,
+                                              keys=keys, convert=convert),
+                                      files, self.jobs, ordered=ordered):
+            if record is not None and convert is None:
+                self._cache(record, keys)
+            yield f, record, reason
+
+    def plan_rename(self, pattern, files, dest=None):
+        """Return the rename plan of `files` with `pattern`, a Pattern or a
+        string, as a list of (file, new name, new path, reason to skip),
+        and the list of its problems: the files missing a tag of the
+        pattern, and the colliding names.  The new names are relative to
+        the `dest` directory if given, or else to the directory of each
+        file, and may name subdirectories."""
+        if not isinstance(pattern, Pattern):
+            pattern = Pattern(pattern)
+        # the files are scanned if the pattern only needs the common tags.
+        keys = pattern.fields if pattern.fields <= set(TAG_KEYS) else None
+
+        plan, problems = [], []
+        for f in files:
+            with stats.file(f):
+                try:
+                    # the record is not worth building if it is not cached.
+                    meta = (self.read(f, keys) if self.cache.size
+                            else read(f, self.index, keys))
+                except _unreadable() as exc:
+                    plan.append((f, None, None, _reason(exc)))
+                    continue
+                step = _step(f, meta, pattern, dest)
+            if step[1] is None:
+                problems.append(step[3])
+            else:
+                plan.append(step)
+
+        problems.extend(conflicts((f, fullname) for f, _, fullname, reason
+                                  in plan if reason is None))
+        return plan, problems
+
+    def rename(self, plan, dry_run=False):
+        """Carry out a rename `plan` without problems, yielding its steps as
+        the files are renamed; the skipped files are only yielded.  The
+        missing directories of the new paths are made, each one once."""
+        if self.journal is not None and not dry_run:
+            self.journal.plan((f, fullname) for f, _, fullname, reason
+                              in plan if reason is None and fullname != f)
+        made = set()
+        for step in plan:
+            f, _, fullname, reason = step
+            yield step
+            if reason is None and not dry_run and fullname != f:
+                directory = os.path.dirname(fullname)
+                if directory and directory not in made:
+                    makedirs(directory)
+                    made.add(directory)
+                self._move(f, fullname)
+                if self.journal is not None:
+                    self.journal.renamed(f, fullname)
+
+    def _move(self, src, dst):
+        move(src, dst)
+        if self.index is not None:
+            self.index.move(src, dst)
+        entry = self.cache.pop(src)
+        if entry is not None:
+            # the size and modification time are kept by the move.
+            entry[0].path = dst
+            self.cache.put(dst, entry)
+
+    def resume(self):
+        """Return the plan of the renames the journal planned and did not
+        carry out, see rename()."""
+        encoding = sys.getfilesystemencoding() or 'utf-8'
+        return [(src, os.path.basename(dst).decode(encoding, 'replace'),
+                 dst, None) for src, dst in self.journal.pending()]
+
+    def undo(self, dry_run=False):
+        """Undo the renames logged to the journal, last first, yielding the
+        steps of the plan as the files are renamed back like rename(); a
+        rename is skipped if its target is gone, or its source taken."""
+        encoding = sys.getfilesystemencoding() or 'utf-8'
+        self.journal.pending()
+        for src, dst in reversed(self.journal.renames[:]):
+            if not os.path.lexists(dst):
+                reason = "'%s' is gone" % dst
+            elif os.path.lexists(src):
+                reason = "'%s' already exists" % src
+            else:
+                reason = None
+            yield (dst, os.path.basename(src).decode(encoding, 'replace'),
+                   src, reason)
+            if reason is None and not dry_run:
+                self._move(dst, src)
+                self.journal.undone(src, dst)
+
+    def _update(self, task, force=False, dry_run=False, pattern=None,
+                dest=None):
+        # the values of the tags are strings, or lists for multi-valued tags.
+        # With a `pattern`, the step of the rename plan of the file follows
+        # the result, worked out from the tags as updated.
+        filename, tags = task
+        keys = set(tags) | pattern.fields if pattern else tags.keys()
+        written = None
+        with stats.file(filename):
+            # the file is not loaded if its cached record has the tags.
+            meta = self._cached(filename, keys)
+            try:
+                if not force and meta is not None and _has(meta, tags):
+                    result = filename, tags, 'unchanged', None
+                else:
+                    meta = load(filename)
+                    if not force and _has(meta, tags):
+                        self._keep(filename, meta)
+                        result = filename, tags, 'unchanged', None
+                    else:
+                        # in memory only for a dry run, to name the file.
+                        meta.update(tags)
+                        if not dry_run:
+                            in_place = save(meta, filename, self.padding)
+                            written = 'in place' if in_place else 'rewritten'
+                            self._keep(filename, meta)
+                            if self.index is not None:
+                                self.index.put(filename, meta)
+                        result = filename, tags, 'ok', written
+            except NotImplementedError as exc:
+                result = filename, tags, 'skipped', exc.message
+            except Exception as exc:
+                result = filename, tags, 'failed', str(exc)
+            if pattern is None:
+                # with a pattern, the file is done once renamed.
+                if (self.journal is not None and not dry_run and
+                        result[2] in ('ok', 'unchanged')):
+                    self.journal.updated(filename)
+                return result
+            if result[2] in ('skipped', 'failed'):
+                return result + (None,)
+            return result + (_step(filename, meta, pattern, dest),)
+
+    def update_many(self, tasks, force=False, dry_run=False):
+        """Update the files with their tags, given as a mapping or an
+        iterable of (file, tags) pairs, the tags keyed by tag name.  Yield
+        (file, tags, status, how) for each file as it is written: the status
+        is 'ok', 'unchanged' if the file already has the tags and `force`
+        is false, 'skipped' or 'failed'; how is 'in place' or 'rewritten'
+        for the files saved, or the reason of the failure.  A failure does
+        not stop the other files, which are written by the `jobs` threads.
+        """
+        if isinstance(tasks, dict):
+            tasks = tasks.iteritems()
+        return pmap(partial(self._update, force=force, dry_run=dry_run),
+                    tasks, self.jobs, threads=True)
+
+    def update_rename(self, tasks, pattern, force=False, dry_run=False,
+                      dest=None):
+        """Update the files like update_many(), and name them with `pattern`
+        from their updated tags under `dest`, see plan_rename(), loading
+        each file once.  Yield (file, tags,
+        status, how, step) for each file as it is written, the step of its
+        rename plan as plan_rename() lists them, or None if the file was
+        skipped or failed; a step without a name is a problem, its reason
+        tells the missing tag.  Check the plan for conflicts() before it
+        is carried out by rename().
+        """
+        if not isinstance(pattern, Pattern):
+            pattern = Pattern(pattern)
+        if isinstance(tasks, dict):
+            tasks = tasks.iteritems()
+        return pmap(partial(self._update, force=force, dry_run=dry_run,
+                            pattern=pattern, dest=dest),
+                    tasks, self.jobs, threads=True)
+
+    def find_dupes(self, files, tolerance=1.0):
+        """Return the groups of `files` holding the same audio, whatever
+        their tags, and the list of (file, reason) of the files skipped.
+        Each group is (digest, payload size, duration, files), the files in
+        the given order, and the groups in the order of their first file.
+
+        The files are first measured from their headers, and only the ones
+        with the same format and payload size as another file, see
+        payload(), and a duration within `tolerance` seconds of it are
+        hashed, by the `jobs` worker processes.
+        """
+        measured, skipped, order = collections.defaultdict(list), [], {}
+        for f, format, size, duration, reason in pmap(_measure, files,
+                                                      self.jobs):
+            if reason is not None:
+                skipped.append((f, reason))
+            else:
+                order[f] = len(order)
+                measured[format, size].append((duration, f))
+
+        # the format, size and duration of the candidates, by file.
+        candidates = {}
+        for (format, size), found in measured.iteritems():
+            found.sort()
+            for (before, a), (after, b) in zip(found, found[1:]):
+                if after - before <= tolerance:
+                    candidates[a] = format, size, before
+                    candidates[b] = format, size, after
+
+        groups = collections.defaultdict(list)
+        for f, digest, reason in pmap(
+                _digest, sorted(candidates, key=order.get), self.jobs):
+            if reason is not None:
+                skipped.append((f, reason))
+            else:
+                groups[candidates[f][0], digest].append(f)
+        return sorted(((digest,) + candidates[found[0]][1:] + (found,)
+                       for (_, digest), found in groups.iteritems()
+                       if len(found) > 1),
+                      key=lambda group: order[group[3][0]]), skipped
+
+
+def argparsed(func):
+    @wraps(func)
+    def wrapped(argv):
+        from docopt import docopt
+        with stats.phase('docopt'):
+            args = docopt(func.__doc__, argv=argv)
+        return func(args)
+    return wrapped
+
+
+def _project(meta, fields=None):
+    # the tags of `meta` as lists of values keyed by tag name, only the
+    # `fields` if given.
+    keys = meta.keys() if fields is None else \
+        [key for key in fields if key in meta]
+    return dict((key, list(meta[key])) for key in keys)
+
+
+def _ndjson(filename, tags):
+    import json
+    tags = dict(tags, file=filename.decode(sys.getfilesystemencoding() or
+                                           'utf-8', 'replace'))
+    return json.dumps(tags, sort_keys=True)
+
+
+def _csv(filename, tags, fields):
+    # the values of a multi-valued tag are separated by semicolons.
+    return [filename] + [u'; '.join(tags.get(key, ())).encode('utf-8')
+                         for key in fields]
+
+
+def _dumped(filename, meta, format='text', fields=None):
+    # the dump of `meta`, formatted by the workers of read_many().
+    with stats.phase('format'):
+        if format == 'text' and fields is None:
+            return meta.pprint()
+        tags = _project(meta, fields)
+        if format == 'ndjson':
+            return _ndjson(filename, tags)
+        elif format == 'csv':
+            return _csv(filename, tags, fields)
+        return Tags(tags).pprint()
+
+
+@argparsed
+def dump(args):
+    """
+usage: tag dump [options] [<files>...]
+
+Dump audio meta data of the <files>.
+
+Options:
+  -r, --recursive=<dir>
+                      Also dump the audio files found under <dir>.
+  --files-from=<file> Also dump the NUL-delimited files listed in <file>,
+                      or in the standard input if <file> is -.
+  --shard=<i/n>       Only dump the files of the shard <i> of <n>, told by
+                      a hash of their path.  See 'tag help merge'.
+  -j, --jobs=<n>      Load the files with <n> worker processes, 0 for one
+                      per CPU [default: 1].
+  --unordered         Print each file as soon as it is loaded instead of
+                      keeping the order of <files>.
+  --io-order=<order>  Read the files in the given order, or sorted by
+                      inode or physical location on the disk to save the
+                      seeks of a hard disk [default: given].
+  --readahead=<n>     Read the tags of the <n> next files ahead while a
+                      file is being read [default: 0].
+  --index=<db>        Serve the unchanged files from the tag index <db>.
+                      See 'tag help index'.
+  --fast              Only dump the tags listed in 'tag help tags', read
+                      straight from the tag headers.
+  --format=<format>   Print the tags as text, as ndjson, one JSON object
+                      per file, or as csv, one row per file [default: text].
+  --fields=<fields>   Only dump the comma-separated <fields> tags, read
+                      straight from the tag headers if they are listed in
+                      'tag help tags'.  They are the csv columns, which
+                      default to the tags listed in 'tag help tags'.
+
+Examples:
+
+  tag dump --format=ndjson --fields=artist,album -r ~/Music > tags.ndjson
+
+    """
+    format = args['--format']
+    if format not in ('text', 'ndjson', 'csv'):
+        sys.exit("%r is not a dump format. See 'tag help dump'." % format)
+    fields = args['--fields'] and [field.strip() for field
+                                   in args['--fields'].split(',')]
+    if format == 'csv' and not fields:
+        fields = list(TAG_KEYS)
+    keys = fields or (TAG_KEYS if args['--fast'] else None)
+
+    if format == 'csv':
+        import csv
+        writer = csv.writer(sys.stdout, lineterminator='\n')
+        writer.writerow(['file'] + fields)
+    # each file is read once, there is nothing to cache.
+    library = Library(_index(args), _jobs(args), cache_size=0)
+    for f, result, reason in library.read_many(
+            _files(args), keys, ordered=not args['--unordered'],
+            convert=partial(_dumped, format=format, fields=fields)):
+        if reason is not None:
+            if format == 'text':
+                print('Skipping %s: %s' % (f, reason))
+            else:
+                print('Skipping %s: %s' % (f, reason), file=sys.stderr)
+        elif format == 'csv':
+            writer.writerow(result)
+        elif format == 'ndjson':
+            print(result)
+        else:
+            print(f)
+            print(result)
+
+
+def _matched(filename, meta, query):
+    # whether `meta` matches the query, told by the workers of read_many().
+    with stats.phase('query'):
+        return query(SimpleDict(meta))
+
+
+@argparsed
+def find(args):
+    """
+usage: tag find [options] <query> [<files>...]
+
+Print the <files> whose tags match the <query>, NUL-delimited to be read
+by the --files-from option of the other commands.  The exit status is 1 if
+no file matches.
+
+The <query> compares the tags with <tag><operator><value>, joined with
+'and', 'or', 'not' and parentheses.  The operators are = != < <= > >=, and
+=~ !~ for a regular expression search.  The comparison is numeric if the
+value is a number, a value with spaces or operators is quoted.  A file
+without the tag matches no comparison, and only the first value of a tag
+is compared.
+
+Options:
+  <query>             The predicate the tags of a file must match. See
+                      'tag help tags' for supported tags.
+  -r, --recursive=<dir>
+                      Also search the audio files found under <dir>.
+  --files-from=<file> Also search the NUL-delimited files listed in <file>,
+                      or in the standard input if <file> is -.
+  -j, --jobs=<n>      Load the files with <n> worker processes, 0 for one
+                      per CPU [default: 1].
+  --newline           Print one file per line instead of NUL-delimited.
+  --io-order=<order>  Read the files in the given order, or sorted by
+                      inode or physical location on the disk to save the
+                      seeks of a hard disk [default: given].
+  --readahead=<n>     Read the tags of the <n> next files ahead while a
+                      file is being read [default: 0].
+  --verbose           Output extra information about the work being done.
+  --index=<db>        Serve the unchanged files from the tag index <db>.
+                      See 'tag help index'.
+
+Examples:
+
+  tag find -r ~/Music "artist=~'Beatles' and tracknumber>10" |
+      tag update --files-from=- --album='Past Masters'
 
-class SimpleDict(object):
-    '''A compatible wrapper for EasyID3 and EasyMP4.'''
-    def __init__(self, meta):
-        self.meta = meta
+    """
+    try:
+        query = Query(args['<query>'].decode('utf-8'))
+    except ValueError as exc:
+        sys.exit("Invalid query: %s. See 'tag help find'." % exc.message)
+    # the files are scanned if the query only needs the common tags.
+    keys = query.fields if query.fields <= set(TAG_KEYS) else None
+    end = '\n' if args['--newline'] else '\x00'
 
-    def __getattr__(self, name):
-        # delegate everything to the self.meta under the hood
-        return getattr(self.meta, name)
+    found = False
+    library = Library(_index(args), _jobs(args), cache_size=0)
+    for f, matched, reason in library.read_many(
+            _files(args), keys, convert=partial(_matched, query=query)):
+        if reason is not None:
+            if args['--verbose']:
+                print('Skipping %s: %s' % (f, reason), file=sys.stderr)
+        elif matched:
+            sys.stdout.write(f + end)
+            found = True
+    return 0 if found else 1
 
-    def __getitem__(self, name):
-        # special care for the tracknumber and discnumber
-        # both of them are rendered as index/total pair.
-        if name in self.meta:
-            if name in ('tracknumber', 'discnumber'):
-                return int(self.meta[name][0].split('/')[0])
-            return self.meta[name][0]
-        else:
-            # FUTURE: extend the tag support, for example: tracktotal
-            raise KeyError(name)
 
+@argparsed
+def dupes(args):
+    """
+usage: tag dupes [options] [<files>...]
 
-def load(filename):
-    """Return a tagging instance."""
-    _, ext = os.path.splitext(filename)
-    if ext == '.m4a':
-        return EasyMP4(filename)
-    elif ext == '.mp3':
-        return EasyID3(filename)
-    else:
-        raise NotImplementedError('unknown extension: %s' % ext)
+Print the groups of <files> holding the same audio, whatever their tags,
+as ndjson, one JSON object per group with the SHA-1 digest, the size and
+the duration of the audio, and the files.  The exit status is 1 if no file
+has a duplicate.
 
+Only the audio payload of a file is compared, without the ID3v2 and ID3v1
+tags of an MP3 or FLAC file, the metadata blocks of a FLAC file, the moov
+atom of an MP4 file, or the header pages of an Ogg file.  The payloads are
+only hashed for the files with the same format and payload size, and about
+the same duration, as another file.
 
-def argparsed(func):
-    @wraps(func)
-    def wrapped(argv):
-        args = docopt(func.__doc__, argv=argv)
-        return func(args)
-    return wrapped
+Options:
+  -r, --recursive=<dir>
+                      Also compare the audio files found under <dir>.
+  --files-from=<file> Also compare the NUL-delimited files listed in
+                      <file>, or in the standard input if <file> is -.
+  -j, --jobs=<n>      Measure and hash the files with <n> worker processes,
+                      0 for one per CPU [default: 1].
+  --tolerance=<s>     The most the durations of duplicates differ by, in
+                      seconds [default: 1].
+  --verbose           Output extra information about the work being done.
+
+Examples:
+
+  tag dupes -j 0 -r ~/Music > dupes.ndjson
+
+    """
+    import json
+    try:
+        tolerance = float(args['--tolerance'])
+    except ValueError:
+        sys.exit('--tolerance must be a number of seconds: %r'
+                 % args['--tolerance'])
+    encoding = sys.getfilesystemencoding() or 'utf-8'
+    library = Library(jobs=_jobs(args), cache_size=0)
+    groups, skipped = library.find_dupes(_files(args), tolerance)
+    if args['--verbose']:
+        for f, reason in skipped:
+            print('Skipping %s: %s' % (f, reason), file=sys.stderr)
+    for digest, size, duration, files in groups:
+        print(json.dumps({
+            'digest': digest,
+            'size': size,
+            'duration': round(duration, 3),
+            'files': [f.decode(encoding, 'replace') for f in files],
+        }, sort_keys=True))
+    return 0 if groups else 1
+
+
+def _path_key(path):
+    # the order of the paths listed by walk(), component by component.
+    return path.split(os.sep)
+
+
+def _lines(fileobj, name, sort=False):
+    # the (order key, line) of the ndjson lines of the output `name` of a
+    # shard, in path order.
+    import json
+    previous = None
+    for number, line in enumerate(fileobj, 1):
+        try:
+            key = _path_key(json.loads(line)['file'])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            sys.exit("%s:%d is not a line of 'tag dump --format=ndjson'."
+                     % (name, number))
+        if not sort and previous is not None and key < previous:
+            sys.exit('%s:%d is not in path order, merge with --sort.'
+                     % (name, number))
+        previous = key
+        yield key, line if line.endswith('\n') else line + '\n'
+
+
+def merge_stats(shards):
+    """Return the stats of the run of several shards, from the stats of
+    each one as written by --stats-json: the shards ran side by side, so
+    the wall time is the longest one, and the rest is summed."""
+    merged = Stats(max([len(shard['slowest']) for shard in shards] + [0]))
+    merged.start()
+    for shard in shards:
+        merged.merge(shard)
+    return dict(merged.as_dict(), wall=max([shard['wall'] for shard
+                                            in shards] + [0.0]),
+                shards=[shard.get('command') for shard in shards])
 
 
 @argparsed
-def dump(args):
+def merge(args):
     """
-usage: tag dump <files>...
+usage: tag merge [options] <files>...
+
+Merge the outputs of the shards of a run of a command with --shard I/N
+into one: the ndjson outputs of 'tag dump --format=ndjson' in the order of
+their paths, which is the order of --recursive, or with --stats, the stats
+written by the --stats-json option of the shards.
+
+Each host runs the command on the same files with its own --shard, and
+handles the files of its shard only, without coordination: a file belongs
+to the shard told by a hash of its path as listed, so the hosts list the
+files under the same path.
+
+The outputs are merged as they are read, and each one must be in path
+order: the files of --recursive, or the sorted <files>, are dumped in path
+order unless the --unordered or --io-order options are given.  An output in
+another order is refused, unless --sort is given.
+
+Options:
+  --stats             Merge the --stats-json files of the shards: the wall
+                      time is the longest one, the phases, files and bytes
+                      are summed.
+  --sort              Sort the lines of the outputs in memory, for the
+                      outputs not in path order.
+  -o, --output=<file> Write the result to <file> instead of stdout.
+
+Examples:
+
+  on each host $i of 3, in a shared directory
+  tag --stats-json=stats.$i.json dump --shard=$i/3 --format=ndjson \\
+      -r /shared/music > tags.$i.ndjson
+
+  then on any host
+  tag merge tags.1.ndjson tags.2.ndjson tags.3.ndjson > tags.ndjson
+  tag merge --stats stats.1.json stats.2.json stats.3.json
 
-Dump audio meta data of the <files>.
     """
-    for f in args['<files>']:
-        try:
-            meta = load(f)
-            print(f)
-            print(meta.pprint())
-        except NotImplementedError as exc:
-            print('Skipping %s: %s' % (f, exc.message))
+    import json
+    output = open(args['--output'], 'w') if args['--output'] else sys.stdout
+    try:
+        if args['--stats']:
+            shards = []
+            for name in args['<files>']:
+                with open(name) as f:
+                    shards.append(json.load(f))
+            json.dump(merge_stats(shards), output, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+            output.write('\n')
+            return 0
+        inputs = [open(name) for name in args['<files>']]
+        lines = [_lines(f, name, args['--sort'])
+                 for f, name in zip(inputs, args['<files>'])]
+        if args['--sort']:
+            merged = sorted(itertools.chain.from_iterable(lines))
+        else:
+            merged = heapq.merge(*lines)
+        for _, line in merged:
+            output.write(line)
+        for f in inputs:
+            f.close()
+        return 0
+    finally:
+        if args['--output']:
+            output.close()
 
 
 @argparsed
 def rename(args):
     """
-usage: tag rename [options] <pattern> <files>...
+usage: tag rename [options] <pattern> [<files>...]
 
 Rename <files> with the naming <pattern> formated by the tags.
 
+All the new names are worked out first, nothing is renamed if a file misses
+a tag of the <pattern>, if two files would get the same name or if a name
+is already taken.
+
+With --shard, the names colliding with the ones of the files of another
+shard are not told before the renames.
+
+The <pattern> may name subdirectories, made as needed, with a / between its
+path components; a / in a tag is replaced with _.  The new names are
+relative to the directory of each file, or to the --dest directory.
+
 Options:
   <pattern>           The file name pattern using python string format
                       syntax. See 'tag help tags' for supported tags.
+  --dest=<root>       Move the files under the <root> directory, such as
+                      the root of a library, named by the <pattern>.
+  -r, --recursive=<dir>
+                      Also rename the audio files found under <dir>.
+  --files-from=<file> Also rename the NUL-delimited files listed in <file>,
+                      or in the standard input if <file> is -.
+  --shard=<i/n>       Only rename the files of the shard <i> of <n>, told by
+                      a hash of their path.  See 'tag help merge'.
+  --io-order=<order>  Read the files in the given order, or sorted by
+                      inode or physical location on the disk to save the
+                      seeks of a hard disk [default: given].
+  --readahead=<n>     Read the tags of the <n> next files ahead while a
+                      file is being read [default: 0].
   -p, --dry-run       Print the action the command will take without
                       actually changing any files.
   --verbose           Output extra information about the work being done.
+  --index=<db>        Serve the unchanged files from the tag index <db>.
+                      See 'tag help index'.
+  --journal=<file>    Log the renames to <file> as they are done, to
+                      resume an interrupted run or undo its renames.  See
+                      'tag help undo'.
+  --resume            Skip the files done by the run logged to the journal
+                      without opening them, and carry out the renames it
+                      planned first, none of them if a target was taken
+                      since.  The <files> may be left out.
 
 Examples:
 
   tag rename '{discnumber}-{tracknumber:02}.{album} - {title}' foo.mp3
+  tag rename --dest ~/Music -r ~/inbox '{albumartist}/{album}/{title}'
 
     """
-    pattern = args['<pattern>']
-    for f in args['<files>']:
-        try:
-            meta = SimpleDict(load(f))
-        except NotImplementedError as exc:
-            if args['--verbose']:
-                print('Skipping %s: %s' % (f, exc.message))
-            continue
+    journal = _journal(args)
+    library = Library(_index(args), cache_size=0, journal=journal)
+    try:
+        files = _files(args)
+        status = _resume(args, library)
+        if status and not args['--dry-run']:
+            return status
+        if args['--resume']:
+            files = (f for f in files if f not in journal)
+        pattern = Pattern(args['<pattern>'].decode('utf-8'))
+        plan, problems = library.plan_rename(pattern, files, args['--dest'])
+        return _rename(library, plan, problems, args['--dry-run'],
+                       args['--verbose']) or status
+    finally:
+        if journal is not None:
+            journal.close()
+
+
+def _journal(args):
+    if args['--resume'] and not args['--journal']:
+        sys.exit('--resume needs a --journal.')
+    return Journal(args['--journal'], args['--resume']) \
+        if args['--journal'] else None
+
+
+def _resume(args, library):
+    # carry out the renames planned by the interrupted run, as planned, none
+    # of them if a target was taken since, like the renames of a new plan.
+    if not args['--resume']:
+        return 0
+    plan = library.resume()
+    problems = list(conflicts((f, fullname) for f, _, fullname, _ in plan))
+    return _rename(library, plan, problems, args['--dry-run'],
+                   args['--verbose'])
+
+
+@argparsed
+def undo(args):
+    """
+usage: tag undo --journal=<file> [options]
+
+Rename back the files renamed by the rename or update commands run with
+the --journal <file>, the last renamed first.  A file is left alone if it
+was removed since, or if its former name is taken; it is reported and the
+exit status is 1.  The updates of the tags are not undone.
 
-        _, ext = os.path.splitext(f)
-        filename = unicode(pattern).format(**meta) + ext
-        print("'%s'  ==>  '%s'" % (f, filename.encode('utf-8')))
-        if not args['--dry-run']:
-            fullname = os.path.join(os.path.dirname(f), filename)
-            shutil.move(f, fullname)
+Options:
+  --journal=<file>    The journal of the renames to undo.
+  -p, --dry-run       Print the action the command will take without
+                      actually changing any files.
+  --index=<db>        Follow the renames in the tag index <db>.  See
+                      'tag help index'.
+
+Examples:
+
+  tag rename --journal=ingest.journal -r ~/inbox '{artist} - {title}'
+  tag undo --journal=ingest.journal
+
+    """
+    if not os.path.exists(args['--journal']):
+        sys.exit('No journal %s.' % args['--journal'])
+    journal = Journal(args['--journal'], resume=True)
+    library = Library(_index(args), cache_size=0, journal=journal)
+    problems = 0
+    try:
+        for src, filename, _, reason in library.undo(args['--dry-run']):
+            if reason is None:
+                print("'%s'  ==>  '%s'" % (src, filename.encode('utf-8')))
+            else:
+                print('Skipping %s: %s' % (src, reason), file=sys.stderr)
+                problems += 1
+    finally:
+        journal.close()
+    return 1 if problems else 0
+
+
+def _rename(library, plan, problems, dry_run=False, verbose=False):
+    # carry out a rename plan, printing it, unless it has problems; they are
+    # printed to stderr, after the plan of a dry run.  Return the status.
+    if problems and not dry_run:
+        for problem in problems:
+            print(problem, file=sys.stderr)
+        print('Nothing renamed.', file=sys.stderr)
+        return 1
+
+    for f, filename, fullname, reason in library.rename(plan, dry_run):
+        if reason is None:
+            print("'%s'  ==>  '%s'" % (f, filename.encode('utf-8')))
+        elif verbose:
+            print('Skipping %s: %s' % (f, reason))
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    return 1 if problems else 0
+
+
+def _values(value):
+    return value if isinstance(value, list) else [value]
 
 
 @argparsed
 def update(args):
     """
 usage:
-  tag update [--tracknumber=<tracknumber>] [options] <files>...
-  tag update [--trackstart=<trackstart>] [options] <files>...
+  tag update [--tracknumber=<tracknumber>] [options] [<files>...]
+  tag update [--trackstart=<trackstart>] [options] [<files>...]
 
 Update the <files> with the specified tags.
 
@@ -134,11 +2638,45 @@ Options:
   --tracknumber=<tracknumber>
                       Set the track number tag metadata.
   --trackstart=<trackstart>
-                      If set, the tracknumber is incremented in ascending order.
+                      If set, the tracknumber is incremented in ascending
+                      order.
+  --rename=<pattern>  Also rename the files with the naming <pattern>
+                      formatted by their updated tags, see 'tag help
+                      rename'.  Each file is loaded once.
+  --dest=<root>       Move the files renamed under the <root> directory.
 
+  -r, --recursive=<dir>
+                      Also update the audio files found under <dir>.
+  --files-from=<file> Also update the NUL-delimited files listed in <file>,
+                      or in the standard input if <file> is -.
+  --shard=<i/n>       Only update the files of the shard <i> of <n>, told by
+                      a hash of their path.  See 'tag help merge'.
+
+  -j, --jobs=<n>      Write the files with <n> worker threads, 0 for one
+                      per CPU [default: 1].
+  --padding=<bytes>   Reserve <bytes> of padding when the tag no longer
+                      fits and the file has to be rewritten, so that the
+                      next updates are written in place (mutagen 1.33+).
+  --force             Save the files even if they already have the tags.
   -p, --dry-run       Print the action the command will take without
                       actually changing any files.
   --verbose           Output extra information about the work being done.
+  --index=<db>        Write the saved tags through to the tag index <db>.
+                      See 'tag help index'.
+  --journal=<file>    Log the updates and renames to <file> as they are
+                      done, to resume an interrupted run or undo its
+                      renames.  See 'tag help undo'.
+  --resume            Skip the files done by the run logged to the journal
+                      without opening them, and carry out the renames it
+                      planned first, none of them if a target was taken
+                      since.  The <files> may be left out.
+
+The files which already have the tags are left untouched.  A file that
+cannot be updated does not stop the others, the failures are listed in the
+summary printed to stderr.  The files updated are renamed once all of them
+are written, and none of them if a name is missing a tag or collides; a
+file is then done for --resume once it is renamed.  With --shard, the
+track numbers of --trackstart count the files of all the shards.
 
 Examples:
 
@@ -148,33 +2686,748 @@ Examples:
   2. update the album track number with sorted order
   tag update --albumartist='Various Artists' --trackstart=50 50.mp3 51.mp3
 
+  3. update and rename the files of an album in one pass
+  tag update --album='Abbey Road' --rename='{tracknumber:02} {title}' *.mp3
+
     """
     def iter(args):
         for k, v in args.items():
-            if k in ('--dry-run', '--trackstart', '--verbose'):
+            if k in ('--dry-run', '--trackstart', '--verbose', '--jobs',
+                     '--index', '--recursive', '--files-from', '--padding',
+                     '--force', '--rename', '--dest', '--journal',
+                     '--resume', '--shard'):
                 continue
             if v is not None and k.startswith('--'):
                 yield (k[2:], v.decode('utf-8'))
 
-    options = dict(iter(args))
-    for index, f in enumerate(args['<files>'],
-                              int(args.get('--trackstart') or 1)):
-        try:
-            meta = load(f)
-        except NotImplementedError as exc:
+    # the track numbers count the files of all the shards.
+    files = _files(args, sharded=not args.get('--trackstart'))
+    shard = args.get('--trackstart') and _shard(args)
+    journal = _journal(args)
+
+    def tasks(options):
+        for index, f in enumerate(files,
+                                  int(args.get('--trackstart') or 1)):
+            if args.get('--trackstart'):
+                options = dict(options, tracknumber=str(index))
+            # the track numbers are kept by the files skipped.
+            if shard and shard_of(f, shard[1]) != shard[0]:
+                continue
+            if not args['--resume'] or f not in journal:
+                yield f, options
+
+    pattern = args['--rename'] and Pattern(args['--rename'].decode('utf-8'))
+    summary = Summary(('ok', 'unchanged', 'skipped', 'failed'))
+    library = Library(_index(args), _jobs(args), cache_size=0,
+                      padding=_padding(args), journal=journal)
+    try:
+        status = _resume(args, library)
+        if status and not args['--dry-run']:
+            return status
+        plan, problems = _updates(args, tasks(dict(iter(args))), summary,
+                                  library, pattern)
+        if pattern:
+            status = _rename(library, plan, problems, args['--dry-run'],
+                             args['--verbose']) or status
+    finally:
+        if journal is not None:
+            journal.close()
+    summary.report()
+    return status or summary.status
+
+
+def _padding(args):
+    try:
+        return args['--padding'] and int(args['--padding'])
+    except ValueError:
+        exit('--padding must be an integer: %r' % args['--padding'])
+
+
+def _updates(args, tasks, summary, library=None, pattern=None):
+    # run the update `tasks` in the writer pool, tallied in `summary`.  With
+    # a `pattern`, the files are named from their updated tags as they are
+    # written, and the rename plan and its problems are returned.
+    library = library or Library(_index(args), _jobs(args), cache_size=0,
+                                 padding=_padding(args))
+    if pattern is None:
+        results = (result + (None,) for result in library.update_many(
+            tasks, args['--force'], args['--dry-run']))
+    else:
+        results = library.update_rename(tasks, pattern, args['--force'],
+                                        args['--dry-run'], args['--dest'])
+    plan, problems = [], []
+    for f, options, status, reason, step in results:
+        if step is not None and step[1] is None:
+            problems.append(step[3])
+        elif step is not None:
+            plan.append(step)
+        summary.add(f, status, reason)
+        if status == 'skipped':
+            if args['--verbose']:
+                print('Skipping %s: %s' % (f, reason))
+        elif status == 'unchanged':
             if args['--verbose']:
-                print('Skipping %s: %s' % (f, exc.message))
+                print('Unchanged %s' % f)
+        elif status == 'ok' and reason and args['--verbose']:
+            print('Updated %s %s' % (f, reason))
+        elif status == 'ok' and args['--dry-run']:
+            print("Update tags for %s:" % f)
+            print("\n".join("%s: %s" % (k, '; '.join(_values(v)))
+                            for k, v in options.items()))
+    problems.extend(conflicts((f, fullname) for f, _, fullname, _ in plan))
+    return plan, problems
+
+
+def read_manifest(fileobj, format):
+    """Yield (line, file, tags, problem) for each row of the `format`
+    manifest read from `fileobj`, csv or ndjson, see 'tag help apply'.  The
+    tags are lists of values keyed by tag name; the problem of a malformed
+    row is given instead."""
+    encoding = sys.getfilesystemencoding() or 'utf-8'
+    if format == 'csv':
+        import csv
+        reader = csv.reader(fileobj)
+        header = next(reader, None)
+        if header is None:
+            return
+        if 'file' not in header:
+            yield 1, None, None, 'no file column'
+            return
+        for row in reader:
+            if not any(row):
+                continue
+            if len(row) != len(header):
+                yield reader.line_num, None, None, 'expected %d columns, ' \
+                    'got %d' % (len(header), len(row))
+                continue
+            row = dict(zip(header, row))
+            tags = dict((key, [v.strip() for v in value.decode('utf-8')
+                               .split(';')])
+                        for key, value in row.items()
+                        if key != 'file' and value)
+            yield reader.line_num, row['file'], tags, None
+        return
+
+    import json
+    for line, text in enumerate(fileobj, 1):
+        if not text.strip():
             continue
+        try:
+            row = json.loads(text)
+            filename = row.pop('file').encode(encoding)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            yield line, None, None, 'not a JSON object with a file'
+            continue
+        tags = dict((key, [unicode(v) for v in _values(value)])
+                    for key, value in row.items() if value is not None)
+        yield line, filename, tags, None
 
-        if args.get('--trackstart'):
-            options.update(tracknumber=str(index))
 
-        if args['--dry-run']:
-            print("Update tags for %s:" % f)
-            print("\n".join("%s: %s" % (k, v) for k, v in options.items()))
+@argparsed
+def apply(args):
+    """
+usage: tag apply [options] --manifest=<file>
+
+Update each file listed in the manifest <file> with its own tags, all in
+the same process.
+
+The manifest is in csv, with a header row naming a 'file' column and a
+column per tag, or in ndjson, one JSON object per file with the 'file' name
+and the tags, just like the output of 'tag dump --format'.  The values of
+a multi-valued tag are separated by semicolons in csv, and listed in
+ndjson.  An empty value leaves the tag untouched.
+
+Options:
+  --manifest=<file>   The manifest, read from the standard input if <file>
+                      is -.
+  --format=<format>   The format of the manifest, csv or ndjson, told by
+                      the extension of <file> if not given.
+  -j, --jobs=<n>      Write the files with <n> worker threads, 0 for one
+                      per CPU [default: 1].
+  --padding=<bytes>   Reserve <bytes> of padding when the tag no longer
+                      fits and the file has to be rewritten (mutagen 1.33+).
+  --force             Save the files even if they already have the tags.
+  -p, --dry-run       Print the action the command will take without
+                      actually changing any files.
+  --verbose           Output extra information about the work being done.
+  --index=<db>        Write the saved tags through to the tag index <db>.
+                      See 'tag help index'.
+
+A malformed row or a file that cannot be updated does not stop the others,
+the failures are listed in the summary printed to stderr.
+
+Examples:
+
+  tag dump --format=csv -r ~/Music > tags.csv
+  # edit the titles of tags.csv
+  tag apply --jobs=4 --manifest=tags.csv
+
+    """
+    manifest = args['--manifest']
+    format = args['--format'] or {
+        '.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson',
+        '.json': 'ndjson'}.get(os.path.splitext(manifest)[1].lower())
+    if format not in ('csv', 'ndjson'):
+        exit("Unknown manifest format, see 'tag help apply'.")
+    summary = Summary(('ok', 'unchanged', 'skipped', 'failed'))
+
+    def tasks(rows):
+        for line, f, tags, problem in rows:
+            if problem is not None:
+                summary.add('%s:%d' % (manifest, line), 'failed', problem)
+            elif tags:
+                yield f, tags
+
+    fileobj = sys.stdin if manifest == '-' else open(manifest, 'rb')
+    try:
+        _updates(args, tasks(read_manifest(fileobj, format)), summary)
+    finally:
+        if fileobj is not sys.stdin:
+            fileobj.close()
+    summary.report()
+    return summary.status
+
+
+def _reindex(filename, index=None):
+    try:
+        index.put(filename, load(filename))
+    except NotImplementedError as exc:
+        return filename, 'skipped', exc.message
+    except Exception as exc:
+        return filename, 'failed', str(exc)
+    return filename, 'ok', None
+
+
+@argparsed
+def index(args):
+    """
+usage:
+  tag index rebuild [options] [<files>...]
+  tag index verify [options] [<files>...]
+
+Maintain the tag index, a cache of the tags keyed by the path, size and
+modification time of the files.  dump and rename serve the unchanged files
+from the index without opening them, and update writes the new tags
+through to it.  They use the index given by their --index option, or
+$TAGCLI_INDEX if it is set.
+
+  rebuild             Load and index the <files> again, or every indexed
+                      file if no <files> are given.
+  verify              Report the <files>, or every indexed file, that are
+                      missing, stale or not indexed.
+
+Options:
+  --index=<db>        The tag index, defaults to $TAGCLI_INDEX, or else
+                      $XDG_CACHE_HOME/tagcli/index.sqlite.
+  -j, --jobs=<n>      Load the files with <n> worker processes, 0 for one
+                      per CPU [default: 1].
+  --prune             Drop the missing files from the index while verifying.
+  --verbose           Output extra information about the work being done.
+
+Examples:
+
+  tag index rebuild --jobs=0 ~/Music/*/*.m4a
+
+    """
+    db = Index(args['--index'] or default_index_path())
+    if args['rebuild']:
+        files = args['<files>'] or [path for path, _, _ in db
+                                    if os.path.exists(path)]
+        summary = Summary()
+        for f, status, reason in pmap(partial(_reindex, index=db), files,
+                                      _jobs(args)):
+            summary.add(f, status, reason)
+            if status == 'skipped' and args['--verbose']:
+                print('Skipping %s: %s' % (f, reason))
+        summary.report()
+        return summary.status
+
+    if args['<files>']:
+        entries = ((os.path.abspath(f), db.stamp(f)) for f in args['<files>'])
+    else:
+        entries = ((path, (size, mtime_ns)) for path, size, mtime_ns
+                   in list(db))
+    problems = 0
+    for path, stamp in entries:
+        if not os.path.exists(path):
+            status = 'missing'
+            if stamp is not None and args['--prune']:
+                db.remove(path)
+        elif stamp is None:
+            status = 'unindexed'
+        elif db.key(path)[1:] != stamp:
+            status = 'stale'
+        else:
+            continue
+        problems += 1
+        print('%s %s' % (status, path))
+    return 1 if problems else 0
+
+
+class _Captured(object):
+    """The output of a served command, kept as UTF-8."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.chunks.append(data)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return ''.join(self.chunks)
+
+
+class _Redirect(object):
+    """Stands for sys.stdin, sys.stdout or sys.stderr in the server, each
+    thread reading from or writing to its own stream if it has one."""
+
+    def __init__(self, default):
+        import threading
+        self.default = default
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        stream = getattr(self.local, 'stream', None)
+        return getattr(self.default if stream is None else stream, name)
+
+    def __iter__(self):
+        return iter(self.__getattr__('readline'), '')
+
+    @contextmanager
+    def redirect(self, stream):
+        self.local.stream = stream
+        try:
+            yield
+        finally:
+            self.local.stream = None
+
+
+class _Workdir(object):
+    """The working directory of the server, shared by the requests from the
+    same directory; a request from another one waits until they are done."""
+
+    def __init__(self):
+        import threading
+        self.cwd = os.getcwd()
+        self.users = 0
+        self.changed = threading.Condition()
+
+    @contextmanager
+    def enter(self, cwd):
+        with self.changed:
+            while self.users and cwd != self.cwd:
+                self.changed.wait()
+            if cwd != self.cwd:
+                os.chdir(cwd)
+                self.cwd = cwd
+            self.users += 1
+        try:
+            yield
+        finally:
+            with self.changed:
+                self.users -= 1
+                self.changed.notify_all()
+
+
+# the commands run by the server.
+SERVED = ('dump', 'find', 'dupes', 'rename', 'update', 'apply', 'index',
+          'undo')
+
+
+def _respond(request, workdir, streams):
+    # run the command of a request with the streams of the thread
+    # redirected, and return the response.
+    from StringIO import StringIO
+    stdin = StringIO(request.get('stdin', u'').encode('utf-8'))
+    stdout, stderr = _Captured(), _Captured()
+    try:
+        argv = [arg.encode('utf-8') for arg in request['argv']]
+        if not argv or argv[0] not in SERVED:
+            raise SystemExit("%r is not a served command. See 'tag help "
+                             "serve'." % (argv[:1] or [''])[0])
+        with streams[0].redirect(stdin):
+            with streams[1].redirect(stdout):
+                with streams[2].redirect(stderr):
+                    with workdir.enter(request.get('cwd') or workdir.cwd):
+                        status = globals()[argv[0]](argv)
+    except SystemExit as exc:
+        status = exc.code
+        if status is not None and not isinstance(status, int):
+            print(status, file=stderr)
+            status = 1
+    except Exception:
+        import traceback
+        stderr.write(traceback.format_exc())
+        status = 1
+    return {'status': status or 0,
+            'stdout': stdout.getvalue().decode('utf-8', 'replace'),
+            'stderr': stderr.getvalue().decode('utf-8', 'replace')}
+
+
+def _serve(conn, slots, workdir, streams):
+    # answer the requests of a connection, one JSON line each.
+    import json
+    with closing(conn):
+        with closing(conn.makefile('rb')) as requests:
+            for line in requests:
+                try:
+                    request = json.loads(line)
+                    request['argv']
+                except (ValueError, KeyError, TypeError):
+                    response = {'status': 1, 'stdout': u'',
+                                'stderr': u'Invalid request.\n'}
+                else:
+                    with slots:
+                        response = _respond(request, workdir, streams)
+                conn.sendall(json.dumps(response) + '\n')
+
+
+def _listen(path):
+    # a socket listening on `path`, in place of the one of a dead server.
+    import socket
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except socket.error:
+            os.unlink(path)
         else:
-            meta.update(options)
-            meta.save(f)
+            exit('A tag server is already listening on %s.' % path)
+        finally:
+            probe.close()
+    # bound aside and moved in place once listening, so that the socket
+    # accepts the connections as soon as it exists.
+    bound = '%s.%d' % (path, os.getpid())
+    server.bind(bound)
+    server.listen(64)
+    os.rename(bound, path)
+    return server
+
+
+def connect(path, argv):
+    """Run the command `argv` in the tag server listening on `path`, print
+    its output and return its exit status."""
+    import json
+    import socket
+    request = {'argv': [arg.decode('utf-8') for arg in argv],
+               'cwd': os.getcwd().decode('utf-8')}
+    if any(arg == '-' or arg.endswith('=-') for arg in argv):
+        request['stdin'] = sys.stdin.read().decode('utf-8')
+    with closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as sock:
+        try:
+            sock.connect(path)
+        except socket.error as exc:
+            exit('Cannot connect to the tag server on %s: %s' % (
+                path, exc.strerror))
+        sock.sendall(json.dumps(request) + '\n')
+        with closing(sock.makefile('rb')) as responses:
+            response = json.loads(responses.readline())
+    sys.stdout.write(response['stdout'].encode('utf-8'))
+    sys.stderr.write(response['stderr'].encode('utf-8'))
+    return response['status']
+
+
+@argparsed
+def serve(args):
+    """
+usage: tag serve [options] --socket=<path>
+
+Serve the tag commands on the Unix domain socket <path>, so that the
+interpreter, docopt and mutagen start up once instead of on every call.
+
+Each request is a JSON line such as {"argv": ["dump", "foo.mp3"], "cwd":
+"/music"}, with the "stdin" of the command if it reads it, and is answered
+by a JSON line with its exit "status", its "stdout" and its "stderr".  The
+strings are UTF-8.  The dump, find, dupes, rename, update, apply, index
+and undo commands are served, a connection may send any number of
+requests.
+
+The 'tag --connect=<path> <command>' client runs a command in the server.
+
+Options:
+  --socket=<path>     The socket to listen on, replaced if no server
+                      listens on it anymore.
+  -j, --jobs=<n>      Run up to <n> requests at a time, 0 for one per CPU
+                      [default: 4].
+
+Examples:
+
+  tag serve --socket=/run/tag.sock &
+  tag --connect=/run/tag.sock dump foo.mp3
+
+    """
+    import signal
+    import threading
+    # the requests change the working directory.
+    path = os.path.abspath(args['--socket'])
+    server = _listen(path)
+    slots = threading.BoundedSemaphore(_jobs(args))
+    workdir = _Workdir()
+    saved = sys.stdin, sys.stdout, sys.stderr
+    streams = sys.stdin, sys.stdout, sys.stderr = tuple(
+        _Redirect(stream) for stream in saved)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            conn, _ = server.accept()
+            thread = threading.Thread(target=_serve, args=(
+                conn, slots, workdir, streams))
+            thread.daemon = True
+            thread.start()
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        sys.stdin, sys.stdout, sys.stderr = saved
+        server.close()
+        os.unlink(path)
+
+
+class Inotify(object):
+    """The audio files written or moved under the `top` directory, told by
+    the Linux inotify API; OSError is raised if it is not available."""
+
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+
+    def __init__(self, top):
+        import ctypes
+        import ctypes.util
+        self.top = top
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+            self.fd = libc.inotify_init()
+        except AttributeError:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        self.dirs = {}
+        self.watch(top)
+
+    def watch(self, top):
+        """Watch `top` and its subdirectories."""
+        import ctypes
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        for dirpath, _, _ in os.walk(top):
+            wd = self._add_watch(self.fd, dirpath, mask)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch failed',
+                              dirpath)
+            self.dirs[wd] = dirpath
+
+    def changes(self, timeout=None):
+        """Return the files changed since the last call, waiting up to
+        `timeout` seconds, or for ever if it is None, for the first one."""
+        import select
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 65536)
+        changed, pos = [], 0
+        while pos < len(data):
+            wd, mask, _, size = struct.unpack_from('iIII', data, pos)
+            name = data[pos + 16:pos + 16 + size].rstrip('\x00')
+            pos += 16 + size
+            if mask & self.IN_Q_OVERFLOW:
+                # the events were lost, every file may have changed.
+                changed.extend(walk(self.top))
+            elif mask & self.IN_IGNORED:
+                self.dirs.pop(wd, None)
+            elif wd not in self.dirs:
+                continue
+            elif mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    # the files may be written before the watch is added.
+                    path = os.path.join(self.dirs[wd], name)
+                    try:
+                        self.watch(path)
+                        changed.extend(walk(path))
+                    except OSError as exc:
+                        # removed or replaced since, like temporary ones.
+                        if exc.errno not in (errno.ENOENT, errno.ENOTDIR):
+                            raise
+            elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                if os.path.splitext(name)[1].lower() in EXTENSIONS:
+                    changed.append(os.path.join(self.dirs[wd], name))
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Poller(object):
+    """The audio files changed under the `top` directory, told by listing it
+    every `interval` seconds, where inotify is not available."""
+
+    def __init__(self, top, interval):
+        self.top = top
+        self.interval = interval
+        self.stamps = self.snapshot()
+        self.polled = default_timer()
+
+    def snapshot(self):
+        # the subdirectories removed during the walk are skipped by walk().
+        try:
+            files = walk(self.top)
+        except OSError as exc:
+            if exc.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            return {}
+        return dict((path, _stamp(path)) for path in files)
+
+    def changes(self, timeout=None):
+        """Return the files changed since the last call, waiting up to
+        `timeout` seconds, or for ever if it is None, for the first one."""
+        import time
+        while True:
+            wait = self.polled + self.interval - default_timer()
+            if timeout is not None and timeout < wait:
+                time.sleep(max(timeout, 0))
+                return []
+            time.sleep(max(wait, 0))
+            if timeout is not None:
+                timeout -= wait
+            stamps = self.snapshot()
+            self.polled = default_timer()
+            changed = [path for path, stamp in sorted(stamps.items())
+                       if stamp is not None and
+                       stamp != self.stamps.get(path)]
+            self.stamps = stamps
+            if changed:
+                return changed
+
+    def close(self):
+        pass
+
+
+@argparsed
+def watch(args):
+    """
+usage: tag watch [options] <dir>
+
+Watch the <dir> directory tree, and update or rename the audio files as
+they are added or changed in it, once their writing is complete.
+
+The files are handled once no change was seen for --settle seconds, in a
+batch with the others ready at the same time.  The changes are told by
+inotify on Linux, at a cost growing with the rate of change, or else by
+listing the whole tree every --poll seconds.  The files renamed or updated
+by the command are not handled again.
+
+Options:
+  --rename=<pattern>  Rename the files with the naming <pattern>, see
+                      'tag help rename'.
+  --dest=<root>       Move the files renamed under the <root> directory.
+  --artist=<artist>   Set the artist tag metadata.
+  --album=<album>     Set the album tag metadata.
+  --title=<title>     Set the title tag metadata.
+  --albumartist=<album-artist>
+                      Set the album artist tag metadata.
+  --discnumber=<discnumber>
+                      Set the disc number tag metadata.
+  --settle=<seconds>  Wait for <seconds> without change before handling a
+                      file [default: 1].
+  --poll=<seconds>    List the tree every <seconds> instead of using
+                      inotify.
+  -j, --jobs=<n>      Write the files with <n> worker threads, 0 for one
+                      per CPU [default: 1].
+  -p, --dry-run       Print the action the command will take without
+                      actually changing any files.
+  --verbose           Output extra information about the work being done.
+  --index=<db>        Serve the unchanged files from the tag index <db>.
+                      See 'tag help index'.
+
+Examples:
+
+  tag watch --rename='{tracknumber:02} {title}' --album=Inbox ~/Inbox
+
+    """
+    import signal
+    top = args['<dir>']
+    if not os.path.isdir(top):
+        exit('%s is not a directory.' % top)
+    pattern = args['--rename'] and Pattern(args['--rename'].decode('utf-8'))
+    options = dict((key, args['--' + key].decode('utf-8')) for key in
+                   ('artist', 'album', 'title', 'albumartist', 'discnumber')
+                   if args['--' + key] is not None)
+    if not (pattern or options):
+        exit("Nothing to do, no --rename nor tags. See 'tag help watch'.")
+    try:
+        settle = float(args['--settle'])
+        poll = args['--poll'] and float(args['--poll'])
+    except ValueError:
+        exit('--settle and --poll must be numbers of seconds.')
+
+    watcher = None
+    if not poll:
+        try:
+            watcher = Inotify(top)
+        except OSError as exc:
+            print('Polling %s: %s' % (top, exc.strerror), file=sys.stderr)
+    if watcher is None:
+        watcher = Poller(top, poll or settle)
+        # a change is only seen at the next listing.
+        settle = max(settle, watcher.interval)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # the time of the last change of the pending files, and the stamps of
+    # the files written by the command, which are not handled again.
+    pending, written = {}, {}
+    # the tags read to rename are cached from a batch to the next one.
+    library = Library(_index(args), _jobs(args))
+    try:
+        while True:
+            timeout = None
+            if pending:
+                timeout = max(min(pending.values()) + settle -
+                              default_timer(), 0)
+            for path in watcher.changes(timeout):
+                pending[path] = default_timer()
+            now = default_timer()
+            ready = sorted(path for path, changed in pending.items()
+                           if now - changed >= settle)
+            batch = []
+            for path in ready:
+                del pending[path]
+                stamp = _stamp(path)
+                if stamp is not None and written.pop(path, None) != stamp:
+                    batch.append(path)
+            if batch:
+                written.update(_watched(args, library, batch, pattern,
+                                        options))
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        watcher.close()
+
+
+def _watched(args, library, files, pattern, options):
+    # update and rename a batch of files, return the stamps of the files
+    # written.
+    if options:
+        # the files are named as they are updated, and loaded once.
+        summary = Summary(('ok', 'unchanged', 'skipped', 'failed'))
+        plan, problems = _updates(dict(args, **{'--force': False}),
+                                  ((f, options) for f in files), summary,
+                                  library, pattern)
+        if summary.failures or args['--verbose']:
+            summary.report()
+    elif pattern:
+        plan, problems = library.plan_rename(pattern, files, args['--dest'])
+    if pattern and not _rename(library, plan, problems, args['--dry-run'],
+                               args['--verbose']):
+        files = [fullname or f for f, _, fullname, _ in plan]
+    sys.stdout.flush()
+    return dict((f, _stamp(f)) for f in files)
 
 
 def help(argv):
@@ -185,6 +3438,7 @@ def help(argv):
         except KeyError:
             exit("%r is not a tag command. See 'tag help'." % cmd)
     else:
+        from docopt import docopt
         docopt(main.__doc__, argv='-h')
 
 
@@ -217,24 +3471,60 @@ def main(argv=None):
     """A mutagen-based tag editor.
 
 Usage:
-  tag <command> [<options>...]
+  tag [options] <command> [<options>...]
 
 
 General Options:
   -h, --help    Show help.
   --version     Show version and exit.
+  --profile     Print the time spent in each phase of the command, the
+                bytes read and written, and the slowest files to stderr.
+  --stats-json=<file>
+                Write the same statistics to <file> as JSON.
+  --slowest=<n>
+                Number of slowest files reported [default: 10].
+  --cprofile=<file>
+                Run the command under cProfile and dump the profile to
+                <file>, for the pstats module.
+  --connect=<path>
+                Run the command in the tag server listening on the socket
+                <path>. See 'tag help serve'.
 
 Commands:
  rename         Rename file using pattern with tags.
  update         Update the tags.
+ apply          Update the files with the tags of a manifest.
  dump           Dumps the tags.
+ find           Find the files whose tags match a query.
+ dupes          Find the files holding the same audio.
+ merge          Merge the outputs of the shards of a run.
  tags           Show generic tag names.
+ index          Maintain the tag index.
+ watch          Update and rename the files added to a directory.
+ undo           Rename back the files renamed with a journal.
+ serve          Serve the commands on a Unix domain socket.
 
 See 'tag help <command>' for more information on a specific command."""
+    argv = argv or sys.argv[1:]
+    if argv == ['--version']:
+        # skip docopt and its import for the most frequent call of scripts.
+        print('tag version %s' % __version__)
+        sys.exit()
+    if argv and argv[0].startswith('--connect='):
+        # the client skips docopt as well, the server parses the command.
+        return connect(argv[0][len('--connect='):], argv[1:])
+
+    start = default_timer()
+    from docopt import docopt
     args = docopt(main.__doc__,
                   version='tag version %s' % __version__,
                   options_first=True,
-                  argv=argv or sys.argv[1:])
+                  argv=argv)
+    parsed = default_timer()
+
+    if args['--connect']:
+        return connect(args['--connect'],
+                       [args['<command>']] + args['<options>'])
 
     cmd = args['<command>']
     try:
@@ -244,7 +3534,30 @@ See 'tag help <command>' for more information on a specific command."""
         exit("%r is not a tag command. See 'tag help'." % cmd)
 
     argv = [args['<command>']] + args['<options>']
-    return method(argv)
+    if not (args['--profile'] or args['--stats-json'] or args['--cprofile']):
+        return method(argv)
+
+    stats.slowest = int(args['--slowest'])
+    stats.start()
+    stats.add('docopt', parsed - start)
+    try:
+        if args['--cprofile']:
+            import cProfile
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(method, argv)
+            finally:
+                profiler.dump_stats(args['--cprofile'])
+        return method(argv)
+    finally:
+        stats.stop()
+        if args['--profile']:
+            stats.report()
+        if args['--stats-json']:
+            import json
+            with open(args['--stats-json'], 'w') as f:
+                json.dump(dict(stats.as_dict(), command=argv), f, indent=2,
+                          sort_keys=True, separators=(',', ': '))
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
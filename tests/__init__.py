@@ -5,6 +5,7 @@ import os
 import sys
 import shutil
 import unittest
+import pytest
 
 from contextlib import contextmanager
 from StringIO import StringIO
@@ -20,6 +21,18 @@ def redirected_io():
     sys.stdout = stdout
 
 
+def copy_fixtures(tmpdir, pairs):
+    """Copy the (name, original) fixtures of tests/data into `tmpdir`,
+    making the directories of the names, and return the copies."""
+    files = []
+    for name, original in pairs:
+        copy = tmpdir.join(name)
+        copy.dirpath().ensure(dir=True)
+        shutil.copy(os.path.join('tests', 'data', original), str(copy))
+        files.append(str(copy))
+    return files
+
+
 class TestCase(unittest.TestCase):
     def setUp(self):
         fd, self.filename = mkstemp(suffix=self.suffix)
@@ -31,3 +44,22 @@ class TestCase(unittest.TestCase):
             os.unlink(self.filename)
         except OSError:
             pass
+
+
+class LibraryTestCase(unittest.TestCase):
+    """A library of the (name, original) `fixtures` copied as the `files`
+    under the `top` directory, with the tmpdir, capsys and monkeypatch
+    fixtures of pytest."""
+    fixtures = ()
+
+    @pytest.fixture(autouse=True)
+    def pytest_fixtures(self, tmpdir, capsys, monkeypatch):
+        self.tmpdir, self.capsys = tmpdir, capsys
+        self.monkeypatch = monkeypatch
+
+    def setUp(self):
+        self.top = str(self.tmpdir)
+        self.files = copy_fixtures(self.tmpdir, self.fixtures)
+
+    def copy(self, original, name):
+        return copy_fixtures(self.tmpdir, [(name, original)])[0]
@@ -1,15 +1,34 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import errno
+import json
 import os
 import os.path
+import pickle
+import pstats
+import shutil
+import socket
+import subprocess
+import sys
+import time
 import unittest
+import mutagen
 import pytest
 
+from StringIO import StringIO
+from tempfile import mkstemp
 from mutagen.easymp4 import EasyMP4
 from mutagen.easyid3 import EasyID3
-from tagcli import SimpleDict, load, main, rename
-from . import redirected_io, TestCase
+from mutagen.flac import FLAC
+from mutagen.oggopus import OggOpus
+from mutagen.oggvorbis import OggVorbis
+import tagcli
+from tagcli import (Index, Library, LRUCache, Pattern, Query, SimpleDict,
+                    TAG_KEYS, TagRecord, load, main, move, order, pmap,
+                    read_files, readahead, rename, scan, sniff, walk,
+                    willneed)
+from . import copy_fixtures, redirected_io, LibraryTestCase, TestCase
 
 
 class TestID3(TestCase):
@@ -29,6 +48,28 @@ date=2004
 genre=Darkwave
 title=Silence
 tracknumber=2
+''' % self.filename
+
+    def test_scan(self):
+        meta = load(self.filename)
+        assert scan(self.filename) == \
+            dict((k, meta[k]) for k in TAG_KEYS if k in meta)
+        assert isinstance(scan(self.filename, ['date']), EasyID3)
+
+    def test_scan_id3v2(self):
+        main(['update', '--artist=Bob Dylan', '--tracknumber=2/12',
+              self.filename])
+        assert scan(self.filename, ['artist', 'tracknumber']) == \
+            {'artist': ['Bob Dylan'], 'tracknumber': ['2/12']}
+
+    def test_dump_fast(self):
+        with redirected_io() as stdout:
+            main(['dump', '--fast', self.filename])
+            assert stdout.getvalue() == '''%s
+album=Quod Libet Test Data
+artist=piman
+title=Silence
+tracknumber=2
 ''' % self.filename
 
     def test_rename(self):
@@ -65,6 +106,12 @@ MPEG-4 audio, 3.71 seconds, 2914 bps (audio/mp4)
 artist=Test Artist
 ''' % self.filename
 
+    def test_scan(self):
+        main(['update', '--tracknumber=3/9', '--title=Zoë', self.filename])
+        assert scan(self.filename) == {'artist': ['Test Artist'],
+                                       'tracknumber': ['3/9'],
+                                       'title': [u'Zo\xeb']}
+
     def test_rename_dryrun(self):
         with redirected_io() as stdout:
             main(['rename',  '--dry-run', '{artist}', self.filename])
@@ -92,6 +139,105 @@ artist: Alice
         main(['update', "--artist=Alice", self.filename])
         assert EasyMP4(self.filename)['artist'][0] == 'Alice'
 
+    def test_update_unchanged(self):
+        os.utime(self.filename, (0, 0))
+        with redirected_io() as stdout:
+            main(['update', '--verbose', '--artist=Test Artist',
+                  self.filename])
+            assert stdout.getvalue() == 'Unchanged %s\n' % self.filename
+        assert os.path.getmtime(self.filename) == 0
+
+        main(['update', '--force', '--artist=Test Artist', self.filename])
+        assert os.path.getmtime(self.filename) > 0
+
+
+class TestFLAC(TestCase):
+    original = os.path.join('tests', 'data', 'silence.flac')
+    suffix = '.flac'
+    kind = FLAC
+
+    def test_load(self):
+        assert isinstance(load(self.filename), self.kind)
+
+    def test_rename(self):
+        with redirected_io() as stdout:
+            main(['rename', '--dry-run', '{tracknumber:02} {artist} - {title}',
+                  self.filename])
+            assert stdout.getvalue() == (
+                "'%s'  ==>  '03 Artist - Silence%s'\n"
+                % (self.filename, self.suffix))
+
+    def test_update(self):
+        main(['update', '--artist=Bob Dylan', '--tracknumber=7',
+              self.filename])
+        meta = self.kind(self.filename)
+        assert meta['artist'] == ['Bob Dylan']
+        assert meta['tracknumber'] == ['7']
+        assert meta['album'] == ['Album']
+
+
+class TestVorbis(TestFLAC):
+    original = os.path.join('tests', 'data', 'silence.ogg')
+    suffix = '.ogg'
+    kind = OggVorbis
+
+
+class TestOpus(TestFLAC):
+    original = os.path.join('tests', 'data', 'silence.opus')
+    suffix = '.opus'
+    kind = OggOpus
+
+
+class TestSniff(LibraryTestCase):
+    def test_extension_case(self):
+        assert isinstance(load(self.copy('silence-44-s-v1.mp3', 'a.MP3')),
+                          EasyID3)
+        assert isinstance(load(self.copy('has-tags.m4a', 'a.mp4')), EasyMP4)
+
+    def test_content(self):
+        # the content wins over a missing or misleading extension.
+        assert isinstance(load(self.copy('has-tags.m4a', 'a.mp3')), EasyMP4)
+        assert isinstance(load(self.copy('silence.flac', 'flac')), FLAC)
+        assert isinstance(load(self.copy('silence.opus', 'a.ogg')), OggOpus)
+        assert scan(self.copy('has-tags.m4a', 'b.mp3'))['artist'] == \
+            ['Test Artist']
+
+    def test_id3_flac(self):
+        filename = self.copy('silence.flac', 'a.flac')
+        with open(filename, 'rb') as f:
+            data = f.read()
+        with open(filename, 'wb') as f:
+            f.write('ID3\x03\x00\x00\x00\x00\x00\x10' + '\x00' * 16 + data)
+        assert sniff(open(filename, 'rb')) == 'flac'
+
+    def test_unknown(self):
+        filename = str(self.tmpdir.join('a.txt'))
+        with open(filename, 'wb') as f:
+            f.write('not audio')
+        with pytest.raises(NotImplementedError):
+            load(filename)
+
+    def test_malformed_id3(self):
+        # the size of the ID3v2 header is not a synchsafe integer.
+        filename = str(self.tmpdir.join('bad.mp3'))
+        with open(filename, 'wb') as f:
+            f.write('ID3\x03\x00\x00\x80\x80\x80\x80' + '\x00' * 64)
+        with pytest.raises(ValueError):
+            load(filename)
+        assert main(['dump', filename]) is None
+        assert self.capsys.readouterr()[0].startswith(
+            'Skipping %s: ' % filename)
+
+    def test_walk(self):
+        self.copy('silence.flac', 'a.FLAC')
+        self.copy('silence.opus', 'b.opus')
+        self.copy('silence.ogg', 'c.oga')
+        self.tmpdir.join('d.txt').write('')
+        with redirected_io() as stdout:
+            main(['rename', '--dry-run', '--recursive', str(self.tmpdir),
+                  '{title}'])
+            assert stdout.getvalue().count("==>  'Silence.") == 3
+
 
 class TestCrossfire(TestCase):
     original = os.path.join('tests', 'data', 'has-tags.m4a')
@@ -118,6 +264,148 @@ artist: Alice
 """ % (self.filename, self.original)
 
 
+class TestRenamePlan(LibraryTestCase):
+    fixtures = [('a.m4a', 'has-tags.m4a'), ('b.m4a', 'has-tags.m4a')]
+
+    def test_duplicates(self):
+        assert main(['rename', '{artist}'] + self.files) == 1
+        assert all(os.path.exists(f) for f in self.files)
+        out, err = self.capsys.readouterr()
+        assert out == ''
+        assert "both rename to" in err
+
+    def test_existing(self):
+        self.tmpdir.join('Test Artist.m4a').write('')
+        assert main(['rename', '{artist}', self.files[0]]) == 1
+        assert os.path.exists(self.files[0])
+        assert 'already exists' in self.capsys.readouterr()[1]
+
+    def test_missing_tag(self):
+        assert main(['rename', '{title}', self.files[0]]) == 1
+        assert os.path.exists(self.files[0])
+        assert 'has no title tag' in self.capsys.readouterr()[1]
+
+    def test_cross_device(self):
+        os.utime(self.files[0], (0, 1000000000))
+        rename = os.rename
+
+        def cross_device(src, dst):
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+        os.rename = cross_device
+        try:
+            move(self.files[0], str(self.tmpdir.join('c.m4a')))
+        finally:
+            os.rename = rename
+        assert not os.path.exists(self.files[0])
+        assert self.tmpdir.join('c.m4a').read() == open(self.files[1]).read()
+        assert self.tmpdir.join('c.m4a').mtime() == 1000000000
+
+    def test_copy_fallback(self):
+        def unsupported(fd_in, fd_out, count):
+            raise OSError(errno.ENOSYS, 'Function not implemented')
+        copies, tagcli._kernel_copies = tagcli._kernel_copies, [unsupported]
+        try:
+            tagcli.copy(self.files[0], str(self.tmpdir.join('c.m4a')))
+        finally:
+            tagcli._kernel_copies = copies
+        assert self.tmpdir.join('c.m4a').read() == open(self.files[0]).read()
+
+    def test_dest(self):
+        dest = self.tmpdir.join('library')
+        assert main(['rename', '--dest', str(dest), '{artist}/AC/DC/{artist}',
+                     self.files[0]]) == 0
+        assert dest.join('Test Artist', 'AC', 'DC', 'Test Artist.m4a').check()
+        assert not os.path.exists(self.files[0])
+
+
+def test_pattern():
+    pattern = Pattern(u'{tracknumber:02} {artist[0]} - {title!r}')
+    assert pattern.fields == set(['tracknumber', 'artist', 'title'])
+    meta = SimpleDict(dict(tracknumber=['3/9'], artist=['Bob'], title=[u'x'],
+                           album=['y']))
+    assert pattern.format(meta) == u"03 B - u'x'"
+    pattern = Pattern(u'{artist}/{album}/{title}')
+    meta = SimpleDict(dict(artist=['AC/DC'], album=['..'], title=['x']))
+    assert pattern.format(meta) == u'AC_DC/__/x'
+
+
+class TestQuery(unittest.TestCase):
+    meta = SimpleDict({'artist': [u'The Beatles'], 'album': [u'Help!'],
+                       'tracknumber': [u'12/14'], 'date': [u'1965']})
+
+    def match(self, query):
+        return Query(query)(self.meta)
+
+    def test_compare(self):
+        assert self.match(u"artist='The Beatles'")
+        assert self.match(u'artist!=Beatles')
+        assert self.match(u'tracknumber>10 and tracknumber<=12')
+        assert not self.match(u'tracknumber>=13')
+        assert self.match(u'date<1966')
+        assert self.match(u'album="Help!"')
+
+    def test_search(self):
+        assert self.match(u"artist=~'Beat'")
+        assert self.match(u"artist=~'(?i)^the beat'")
+        assert not self.match(u"artist!~'Beat'")
+
+    def test_logic(self):
+        assert self.match(u"not artist=Stones or album=~Help")
+        assert not self.match(u"artist=Stones or (album=~Help and date>2000)")
+        assert self.match(u"not (artist=Stones)")
+
+    def test_missing(self):
+        assert not self.match(u'title=Yesterday')
+        assert not self.match(u'title!=Yesterday')
+        assert self.match(u'not title=Yesterday')
+
+    def test_short_circuit(self):
+        # the tags are only looked up as needed.
+        query = Query(u"artist=Stones and title=x or album='Help!'")
+        assert query.fields == set(['artist', 'title', 'album'])
+        looked = []
+        meta = {'artist': 'Beatles', 'album': 'Help!'}
+
+        class Meta(object):
+            def __getitem__(self, name):
+                looked.append(name)
+                return meta[name]
+        assert query(Meta())
+        assert looked == ['artist', 'album']
+
+    def test_invalid(self):
+        for query in (u'artist', u'artist=', u'(artist=x', u'artist=x)',
+                      u'artist~x', u'artist=x album=y', u'artist=x and',
+                      u"artist=~'('"):
+            with pytest.raises(ValueError):
+                Query(query)
+
+
+def test_find(capsys):
+    files = [os.path.join('tests', 'data', name) for name in
+             ('silence-44-s-v1.mp3', 'has-tags.m4a', 'silence.flac')]
+    assert main(['find', "artist=~'^(piman|Artist)$'"] + files) == 0
+    assert capsys.readouterr()[0] == files[0] + '\x00' + files[2] + '\x00'
+    assert main(['find', '--jobs=2', '--newline', 'tracknumber>2'] +
+                files) == 0
+    assert capsys.readouterr()[0] == files[2] + '\n'
+    assert main(['find', 'artist=nobody'] + files) == 1
+    assert capsys.readouterr()[0] == ''
+    with pytest.raises(SystemExit):
+        main(['find', 'artist'] + files)
+
+
+def test_find_files_from(capsys):
+    files = [os.path.join('tests', 'data', name) for name in
+             ('silence-44-s-v1.mp3', 'has-tags.m4a')]
+    stdin, sys.stdin = sys.stdin, StringIO('\x00'.join(files))
+    try:
+        assert main(['find', '--files-from=-', 'artist=piman']) == 0
+    finally:
+        sys.stdin = stdin
+    assert capsys.readouterr()[0] == files[0] + '\x00'
+
+
 class TestSimpleDict(unittest.TestCase):
     def setUp(self):
         self.dict = SimpleDict(dict(foo=['egg'], bar=['spam']))
@@ -175,6 +463,941 @@ Skipping %s: unknown extension: .bar
 ''' % (foo, bar)
 
 
+class TestParallelDump(unittest.TestCase):
+    files = [os.path.join('tests', 'data', 'silence-44-s-v1.mp3'),
+             '/tmp/non_exist.bar',
+             os.path.join('tests', 'data', 'has-tags.m4a')]
+
+    def dump(self, *options):
+        with redirected_io() as stdout:
+            main(['dump'] + list(options) + self.files)
+            return stdout.getvalue()
+
+    def test_jobs(self):
+        assert self.dump('--jobs=2') == self.dump()
+
+    def test_unordered(self):
+        output = self.dump('--jobs=2', '--unordered')
+        assert sorted(output.splitlines()) == sorted(self.dump().splitlines())
+
+    def test_skipping(self):
+        assert 'Skipping /tmp/non_exist.bar: unknown extension: .bar\n' in \
+            self.dump('--jobs=3')
+
+
+class TestDumpFormat(unittest.TestCase):
+    files = [os.path.join('tests', 'data', 'silence-44-s-v1.mp3'),
+             '/tmp/non_exist.bar',
+             os.path.join('tests', 'data', 'silence.flac')]
+
+    @pytest.fixture(autouse=True)
+    def capture(self, capsys):
+        self.capsys = capsys
+
+    def dump(self, *options):
+        main(['dump'] + list(options) + self.files)
+        out, err = self.capsys.readouterr()
+        assert err == 'Skipping /tmp/non_exist.bar: unknown extension: .bar\n'
+        return out
+
+    def test_ndjson(self):
+        out = self.dump('--format=ndjson',
+                        '--fields=artist,tracknumber,date')
+        assert [json.loads(line) for line in out.splitlines()] == [
+            {'file': self.files[0], 'artist': ['piman'],
+             'tracknumber': ['2'], 'date': ['2004']},
+            {'file': self.files[2], 'artist': ['Artist'],
+             'tracknumber': ['3/10']}]
+
+    def test_ndjson_all(self):
+        out = self.dump('--format=ndjson')
+        assert json.loads(out.splitlines()[0])['genre'] == ['Darkwave']
+
+    def test_csv(self):
+        assert self.dump('--format=csv') == \
+            """file,artist,albumartist,album,title,discnumber,tracknumber
+%s,piman,,Quod Libet Test Data,Silence,,2
+%s,Artist,,Album,Silence,1,3/10
+""" % (self.files[0], self.files[2])
+
+    def test_text_fields(self):
+        main(['dump', '--fields=title,artist', self.files[0]])
+        assert self.capsys.readouterr()[0] == \
+            '%s\nartist=piman\ntitle=Silence\n' % self.files[0]
+
+    def test_unknown_format(self):
+        with pytest.raises(SystemExit):
+            main(['dump', '--format=xml', self.files[0]])
+
+
+def test_pmap():
+    assert list(pmap(abs, range(-20, 0), 3)) == list(range(20, 0, -1))
+    assert sorted(pmap(abs, range(-20, 0), 3, ordered=False)) == \
+        list(range(1, 21))
+
+
+def test_pmap_error():
+    with pytest.raises(TypeError):
+        list(pmap(abs, ['foo'], 2))
+
+
+class TestPadding(TestCase):
+    original = os.path.join('tests', 'data', 'silence-44-s-v1.mp3')
+    suffix = '.mp3'
+
+    def update(self, *options):
+        with redirected_io() as stdout:
+            main(['update', '--verbose'] + list(options) + [self.filename])
+            return stdout.getvalue()
+
+    def test_in_place(self):
+        assert self.update('--artist=Bob') == \
+            'Updated %s rewritten\n' % self.filename
+        assert self.update('--artist=Bob Dylan') == \
+            'Updated %s in place\n' % self.filename
+
+    @pytest.mark.skipif(mutagen.version < (1, 33),
+                        reason='no padding policy before mutagen 1.33')
+    def test_padding(self):
+        self.update('--padding=8192', '--artist=Bob')
+        size = os.path.getsize(self.filename)
+        assert size > os.path.getsize(self.original) + 8192
+        assert self.update('--title=%s' % ('x' * 4096)) == \
+            'Updated %s in place\n' % self.filename
+        assert os.path.getsize(self.filename) == size
+
+
+def test_update_jobs(tmpdir, capsys):
+    files = copy_fixtures(tmpdir, [('a.mp3', 'silence-44-s-v1.mp3'),
+                                   ('b.m4a', 'has-tags.m4a'),
+                                   ('c.m4a', 'has-tags.m4a')])
+    missing = str(tmpdir.join('missing.mp3'))
+
+    status = main(['update', '--jobs=2', '--artist=Alice', files[0], missing,
+                   files[1], '/tmp/non_exist.bar', files[2]])
+    assert status == 1
+    for f in files:
+        assert load(f)['artist'] == ['Alice']
+    out, err = capsys.readouterr()
+    assert err.splitlines()[0].endswith(', 1 skipped, 1 failed')
+    assert err.splitlines()[1].startswith('  %s: ' % missing)
+
+
+def test_update_rename(tmpdir, capsys):
+    files = copy_fixtures(tmpdir, [('a.mp3', 'silence-44-s-v1.mp3'),
+                                   ('b.m4a', 'has-tags.m4a')])
+
+    # the names come from the updated tags, nothing is renamed on a dry run.
+    assert main(['update', '--dry-run', '--album=Abbey Road',
+                 '--rename={album} - {artist}'] + files) == 0
+    out, _ = capsys.readouterr()
+    assert "==>  'Abbey Road - piman.mp3'" in out
+    assert all(os.path.exists(f) for f in files)
+
+    assert main(['update', '--album=Abbey Road',
+                 '--rename={album} - {artist}'] + files) == 0
+    renamed = str(tmpdir.join('Abbey Road - Test Artist.m4a'))
+    assert load(renamed)['album'] == ['Abbey Road']
+    assert not os.path.exists(files[1])
+
+    # the files are updated, but not renamed if a tag is missing.
+    files = [str(tmpdir.join('Abbey Road - piman.mp3')), renamed]
+    assert main(['update', '--album=Let It Be',
+                 '--rename={album} - {genre}'] + files) == 1
+    _, err = capsys.readouterr()
+    assert 'Nothing renamed.' in err
+    assert all(load(f)['album'] == ['Let It Be'] for f in files)
+
+
+class TestApply(LibraryTestCase):
+    fixtures = [('a.mp3', 'silence-44-s-v1.mp3'), ('b.flac', 'silence.flac')]
+
+    def manifest(self, name, text):
+        self.tmpdir.join(name).write(text)
+        return '--manifest=%s' % self.tmpdir.join(name)
+
+    def test_csv(self):
+        manifest = self.manifest('tags.csv', """file,title,artist
+%s,One,
+%s,Two,Bob; Alice
+""" % tuple(self.files))
+        assert main(['apply', '--jobs=2', manifest]) == 0
+        assert load(self.files[0])['title'] == ['One']
+        assert load(self.files[0])['artist'] == ['piman']
+        assert load(self.files[1])['artist'] == ['Bob', 'Alice']
+        assert self.capsys.readouterr()[1].startswith('2 ok')
+
+    def test_ndjson(self):
+        manifest = self.manifest('tags.ndjson', '\n'.join(json.dumps(row) for
+                                 row in ({'file': self.files[0],
+                                          'tracknumber': 7},
+                                         {'file': self.files[1],
+                                          'title': ['Silence']},
+                                         ['garbage'])))
+        assert main(['apply', manifest]) == 1
+        assert load(self.files[0])['tracknumber'] == ['7']
+        err = self.capsys.readouterr()[1]
+        assert err.splitlines() == [
+            '1 ok (1 rewritten), 1 unchanged, 0 skipped, 1 failed',
+            '  %s:3: not a JSON object with a file' % manifest[11:]]
+
+    def test_dry_run(self):
+        manifest = self.manifest('tags.csv', 'file,title\n%s,One\n' %
+                                 self.files[0])
+        main(['apply', '--dry-run', manifest])
+        assert self.capsys.readouterr()[0] == \
+            'Update tags for %s:\ntitle: One\n' % self.files[0]
+        assert load(self.files[0])['title'] == ['Silence']
+
+    def test_unknown_format(self):
+        with pytest.raises(SystemExit):
+            main(['apply', self.manifest('tags.txt', '')])
+
+
+class TestIndex(TestCase):
+    original = os.path.join('tests', 'data', 'has-tags.m4a')
+    suffix = '.m4a'
+
+    def setUp(self):
+        super(TestIndex, self).setUp()
+        fd, self.db = mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.index = '--index=%s' % self.db
+
+    def tearDown(self):
+        super(TestIndex, self).tearDown()
+        os.unlink(self.db)
+
+    def dump(self):
+        with redirected_io() as stdout:
+            main(['dump', self.index, self.filename])
+            return stdout.getvalue()
+
+    def test_dump(self):
+        output = self.dump()
+        original, tagcli.load = tagcli.load, None
+        try:
+            assert self.dump() == output
+        finally:
+            tagcli.load = original
+
+    def test_update(self):
+        self.dump()
+        main(['update', self.index, '--artist=Alice', self.filename])
+        assert Index(self.db).read(self.filename)['artist'] == ['Alice']
+        assert 'artist=Alice' in self.dump()
+
+    def test_pickle(self):
+        # the tasks handed to a worker share one instance and connection.
+        index = Index(self.db)
+        copies = [pickle.loads(pickle.dumps(index)) for _ in range(2)]
+        assert copies[0] is copies[1]
+        assert copies[0].path == self.db
+        assert copies[0].db is copies[1].db
+
+    def test_stale(self):
+        self.dump()
+        EasyMP4(self.filename).save()
+        with redirected_io() as stdout:
+            assert main(['index', 'verify', self.index]) == 1
+            assert stdout.getvalue() == 'stale %s\n' % self.filename
+        main(['index', 'rebuild', self.index])
+        assert main(['index', 'verify', self.index]) == 0
+
+    def test_missing(self):
+        self.dump()
+        os.unlink(self.filename)
+        with redirected_io() as stdout:
+            assert main(['index', 'verify', '--prune', self.index]) == 1
+            assert stdout.getvalue() == 'missing %s\n' % self.filename
+        assert list(Index(self.db)) == []
+
+    def test_rename(self):
+        self.dump()
+        with redirected_io():
+            main(['rename', self.index, '{artist}', self.filename])
+        f = os.path.join(os.path.dirname(self.filename), 'Test Artist.m4a')
+        try:
+            assert [path for path, _, _ in Index(self.db)] == [f]
+        finally:
+            os.unlink(f)
+
+
+class TestDiscovery(LibraryTestCase):
+    fixtures = [('a/1.mp3', 'silence-44-s-v1.mp3'),
+                ('b/2.mp3', 'silence-44-s-v1.mp3'),
+                ('b/c/3.m4a', 'has-tags.m4a')]
+
+    def setUp(self):
+        super(TestDiscovery, self).setUp()
+        self.tmpdir.join('b', 'cover.jpg').write('')
+
+    def test_walk(self):
+        assert list(walk(self.top)) == self.files
+
+    def test_read_files(self):
+        data = '\x00'.join(self.files) + '\x00'
+        assert list(read_files(StringIO(data), bufsize=7)) == self.files
+        assert list(read_files(StringIO(data[:-1]))) == self.files
+
+    def test_files_from(self):
+        stdin, sys.stdin = sys.stdin, StringIO('\x00'.join(self.files[:2]))
+        try:
+            with redirected_io() as stdout:
+                main(['rename', '--dry-run', '--files-from=-', '{artist}'])
+                assert stdout.getvalue().count("==>  'piman.mp3'") == 2
+        finally:
+            sys.stdin = stdin
+
+    def test_files_from_file(self):
+        listing = os.path.join(self.top, 'listing')
+        with open(listing, 'wb') as f:
+            f.write('\x00'.join(self.files))
+        opened = []
+
+        def recorded(*args):
+            opened.append(open(*args))
+            return opened[-1]
+        tagcli.open = recorded
+        try:
+            with redirected_io() as stdout:
+                main(['dump', '--files-from', listing])
+                assert all(f in stdout.getvalue().splitlines()
+                           for f in self.files)
+        finally:
+            del tagcli.open
+        # the files are opened for their format too.
+        assert opened[0].name == listing
+        assert all(f.closed for f in opened)
+
+    def test_recursive(self):
+        with redirected_io() as stdout:
+            main(['update', '--dry-run', '--recursive', self.top,
+                  '--trackstart=1', '--artist=Alice'])
+            assert stdout.getvalue().count('tracknumber: ') == 3
+
+    def test_io_order(self):
+        files = iter(self.files)
+        assert order(files) is files
+        inodes = sorted((os.stat(f).st_ino, f) for f in self.files)
+        assert order(self.files, 'inode') == [f for _, f in inodes]
+        # the physical order falls back to the inode order without FIEMAP.
+        assert sorted(order(self.files + ['missing.mp3'], 'physical')) == \
+            sorted(self.files + ['missing.mp3'])
+
+    def test_readahead(self):
+        if not willneed(self.files[0]):
+            pytest.skip('posix_fadvise() is not available')
+        assert not willneed('missing.mp3')
+        assert list(readahead(iter(self.files), 2)) == self.files
+        assert list(readahead(self.files, 5)) == self.files
+
+    def test_io_order_dump(self):
+        with redirected_io() as stdout:
+            main(['dump', '--io-order=physical', '--readahead=2',
+                  '--recursive', self.top])
+            assert sorted(line for line in stdout.getvalue().splitlines()
+                          if line in self.files) == self.files
+        with pytest.raises(SystemExit):
+            main(['dump', '--io-order=random', '--recursive', self.top])
+
+    def test_missing_files(self):
+        with pytest.raises(SystemExit):
+            main(['dump'])
+        missing = os.path.join(self.top, 'missing')
+        for option in ('--recursive', '--files-from'):
+            with pytest.raises(SystemExit) as exc:
+                main(['dump', option, missing])
+            assert str(exc.value).startswith('Cannot ')
+            assert missing in str(exc.value)
+
+    def test_unlisted(self):
+        # a directory which cannot be listed is skipped, not the others.
+        def listdir(top, listdir=tagcli._listdir):
+            if top.endswith('c'):
+                raise OSError(errno.EACCES, 'Permission denied', top)
+            return listdir(top)
+        self.monkeypatch.setattr(tagcli, '_listdir', listdir)
+        assert list(walk(self.top)) == self.files[:2]
+        main(['dump', '-r', self.top])
+        out, err = self.capsys.readouterr()
+        assert all(f in out.splitlines() for f in self.files[:2])
+        assert err == 'Skipping %s: Permission denied\n' % os.path.join(
+            self.top, 'b', 'c')
+
+    def test_unreadable(self):
+        # an untagged or corrupt file is skipped, the others are handled.
+        bad = os.path.join(self.top, 'b', 'bad.mp3')
+        with open(bad, 'wb') as f:
+            f.write('not an MPEG stream\n' * 10)
+        empty = os.path.join(self.top, 'a', 'empty.m4a')
+        open(empty, 'wb').close()
+        for jobs in ('1', '2'):
+            with redirected_io() as stdout:
+                main(['dump', '--jobs', jobs, '-r', self.top])
+                out = stdout.getvalue()
+            assert 'Skipping %s: ' % bad in out
+            assert 'Skipping %s: ' % empty in out
+            assert all(f in out.splitlines() for f in self.files)
+            with redirected_io() as stdout:
+                assert main(['find', '--jobs', jobs, '--newline', '-r',
+                             self.top, 'artist=piman']) == 0
+                assert stdout.getvalue() == '\n'.join(self.files[:2]) + '\n'
+        with redirected_io() as stdout:
+            assert main(['rename', '--dry-run', '--verbose', '-r', self.top,
+                         '{artist}']) == 0
+            assert 'Skipping %s: ' % bad in stdout.getvalue()
+            assert stdout.getvalue().count('==>') == 3
+
+
+class TestProfile(unittest.TestCase):
+    files = [os.path.join('tests', 'data', 'silence-44-s-v1.mp3'),
+             os.path.join('tests', 'data', 'has-tags.m4a')]
+
+    @pytest.fixture(autouse=True)
+    def output(self, tmpdir, capsys):
+        self.json = str(tmpdir.join('stats.json'))
+        self.capsys = capsys
+
+    def profile(self, *argv):
+        main(['--stats-json=%s' % self.json, '--profile'] + list(argv))
+        return json.load(open(self.json))
+
+    def test_dump(self):
+        result = self.profile('dump', *self.files)
+        assert result['command'] == ['dump'] + self.files
+        assert result['files'] == 2
+        assert result['phases']['load']['count'] == 2
+        assert result['phases']['format']['count'] == 2
+        assert set(entry['file'] for entry in result['slowest']) == \
+            set(self.files)
+        assert 'slowest files:' in self.capsys.readouterr()[1]
+
+    def test_jobs(self):
+        result = self.profile('--slowest=1', 'dump', '--jobs=2', *self.files)
+        assert result['files'] == 2
+        assert result['phases']['load']['count'] == 2
+        assert len(result['slowest']) == 1
+
+    def test_cprofile(self):
+        dump = self.json + '.prof'
+        main(['--cprofile=%s' % dump, 'dump'] + self.files)
+        assert pstats.Stats(dump).total_calls > 0
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)  # evicts b, the least recently used
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == (1, None, 3)
+    assert cache.pop('a') == 1 and len(cache) == 1
+    empty = LRUCache(0)
+    empty.put('a', 1)
+    assert empty.get('a') is None
+
+
+def test_tag_record():
+    tags = {'artist': [u'Artist'], 'title': ['T\xc3\xaftle'],
+            'genre': [u'Pop', u'Rock']}
+    record = TagRecord('a.mp3', tags, (10, 1.5))
+    assert sorted(record) == ['artist', 'genre', 'title'] == sorted(tags)
+    assert record['title'] == [u'T\xeftle']
+    assert record['genre'] == tags['genre']
+    assert 'album' not in record and record.get('album') is None
+    with pytest.raises(KeyError):
+        record['album']
+    assert SimpleDict(record)['artist'] == u'Artist'
+    copy = pickle.loads(pickle.dumps(record))
+    assert (copy.path, copy.stamp) == ('a.mp3', (10, 1.5))
+    assert dict(copy.items()) == dict(record.items())
+    # the artists are held once.
+    assert copy._values[0] is record._values[0]
+    assert TagRecord('b.mp3', {}).stamp is None
+
+
+def test_tag_record_keysets(monkeypatch):
+    # the sets of tag names held once are bounded, not the records.
+    monkeypatch.setattr(tagcli, '_keysets', {})
+    monkeypatch.setattr(tagcli, '_KEYSETS_SIZE', 2)
+    records = [TagRecord('%d.mp3' % i, {'tag%d' % i: [u'v']})
+               for i in range(4)]
+    assert len(tagcli._keysets) == 2
+    assert records[3]['tag3'] == [u'v']
+    assert TagRecord('a.mp3', {'tag0': []})._keys is records[0]._keys
+
+
+class TestLibrary(LibraryTestCase):
+    fixtures = [('a.mp3', 'silence-44-s-v1.mp3'), ('b.flac', 'silence.flac')]
+
+    def setUp(self):
+        super(TestLibrary, self).setUp()
+        self.loaded = []
+
+        def counted(filename, load=tagcli.load):
+            self.loaded.append(filename)
+            return load(filename)
+        self.monkeypatch.setattr(tagcli, 'load', counted)
+
+    def test_read_many(self):
+        library = Library(cache_size=10)
+        results = list(library.read_many(iter(self.files + ['/tmp/a.bar'])))
+        assert [f for f, _, _ in results] == self.files + ['/tmp/a.bar']
+        assert results[0][1]['artist'] == ['piman']
+        assert results[2][1:] == (None, 'unknown extension: .bar')
+        assert library.read(self.files[1])['title'] == ['Silence']
+        assert self.loaded == self.files + ['/tmp/a.bar']
+
+    def test_read_many_jobs(self):
+        library = Library(jobs=2)
+        results = dict((f, meta) for f, meta, _ in
+                       library.read_many(self.files))
+        assert results[self.files[1]]['artist'] == ['Artist']
+        assert library.read(self.files[1]) is results[self.files[1]]
+
+    def test_changed(self):
+        library = Library()
+        library.read(self.files[0])
+        os.utime(self.files[0], (0, 0))
+        library.read(self.files[0])
+        assert len(self.loaded) == 2
+
+    def test_rename(self):
+        library = Library()
+        plan, problems = library.plan_rename(u'{artist}', self.files)
+        assert problems == []
+        assert [name for _, name, _, _ in plan] == [u'piman.mp3',
+                                                    u'Artist.flac']
+        assert list(library.rename(plan)) == plan
+        assert all(os.path.exists(path) for _, _, path, _ in plan)
+        # the MP3 file was scanned for the artist, which is cached.
+        assert library.read(plan[0][2], ['artist'])['artist'] == ['piman']
+        assert self.loaded == [self.files[1]]
+
+    def test_update_many(self):
+        library = Library(jobs=2)
+        results = list(library.update_many({self.files[0]: {'album': u'X'},
+                                            self.files[1]: {'title': u'Y'}}))
+        assert sorted(status for _, _, status, _ in results) == ['ok', 'ok']
+        assert library.read(self.files[0])['album'] == ['X']
+        assert library.read(self.files[1])['title'] == ['Y']
+        assert sorted(self.loaded) == sorted(self.files)
+        assert [status for _, _, status, _ in library.update_many(
+            [(self.files[0], {'album': u'X'})])] == ['unchanged']
+        # the unchanged file is told by its cached record.
+        assert sorted(self.loaded) == sorted(self.files)
+
+    def test_update_rename(self):
+        library = Library(cache_size=0)
+        results = list(library.update_rename(
+            [(self.files[0], {'album': u'X'}), (self.files[1], {})],
+            u'{album} {title}'))
+        assert [status for _, _, status, _, _ in results] == ['ok',
+                                                              'unchanged']
+        assert results[0][4][1] == u'X Silence.mp3'
+        assert results[1][4][1] == u'Album Silence.flac'
+        # each file was loaded once, to be updated and named.
+        assert self.loaded == self.files
+
+    def test_rename_dest(self):
+        made = []
+        makedirs = tagcli.makedirs
+        tagcli.makedirs = lambda path: made.append(makedirs(path) or path)
+        dest = os.path.join(os.path.dirname(self.files[0]), 'library')
+        try:
+            library = Library()
+            plan, problems = library.plan_rename(u'Various/{artist}',
+                                                 self.files, dest)
+            assert problems == []
+            list(library.rename(plan))
+        finally:
+            tagcli.makedirs = makedirs
+        assert [path for _, _, path, _ in plan] == [
+            os.path.join(dest, 'Various', 'piman.mp3'),
+            os.path.join(dest, 'Various', 'Artist.flac')]
+        assert all(os.path.exists(path) for _, _, path, _ in plan)
+        # the directory was made for the first file only.
+        assert made == [os.path.join(dest, 'Various')]
+
+
+class TestJournal(LibraryTestCase):
+    fixtures = [('%d.mp3' % n, 'silence-44-s-v1.mp3') for n in range(1, 4)]
+
+    def setUp(self):
+        super(TestJournal, self).setUp()
+        for n, f in enumerate(self.files, 1):
+            meta = load(f)
+            meta['title'] = u'T%d' % n
+            meta.save()
+        self.journal = str(self.tmpdir.join('journal'))
+        self.read = []
+
+        def counted(read):
+            def counted(filename, *args):
+                self.read.append(filename)
+                return read(filename, *args)
+            return counted
+        self.monkeypatch.setattr(tagcli, 'load', counted(tagcli.load))
+        self.monkeypatch.setattr(tagcli, 'scan', counted(tagcli.scan))
+
+    def renamed(self, n):
+        return str(self.tmpdir.join('T%d.mp3' % n))
+
+    def test_resume_rename(self):
+        with redirected_io():
+            main(['rename', '--journal=%s' % self.journal, '{title}',
+                  self.files[0]])
+        # a crash after the second rename was planned, in the middle of
+        # the log of the third one.
+        with open(self.journal, 'ab') as journal:
+            journal.write('rename\x00%s\x00%s\x00\n' % (self.files[1],
+                                                        self.renamed(2)))
+            journal.write('rename\x00%s' % self.files[2])
+        self.read = []
+        with redirected_io() as stdout:
+            assert main(['rename', '--journal=%s' % self.journal,
+                         '--resume', '{title}', self.renamed(1)] +
+                        self.files[1:]) == 0
+            assert stdout.getvalue().count('==>') == 2
+        assert all(os.path.exists(self.renamed(n)) for n in (1, 2, 3))
+        # only the file not planned was read.
+        assert self.read == [self.files[2]]
+
+    def test_resume_taken(self):
+        with redirected_io():
+            main(['rename', '--journal=%s' % self.journal, '{title}',
+                  self.files[0]])
+        with open(self.journal, 'ab') as journal:
+            journal.write('rename\x00%s\x00%s\x00\n' % (self.files[1],
+                                                          self.renamed(2)))
+        # the target of the planned rename is taken since the crash.
+        with open(self.renamed(2), 'wb') as f:
+            f.write('precious')
+        resume = ['rename', '--journal=%s' % self.journal, '--resume',
+                  '{title}']
+        assert main(resume) == 1
+        assert 'already exists' in self.capsys.readouterr()[1]
+        assert open(self.renamed(2), 'rb').read() == 'precious'
+        assert os.path.exists(self.files[1])
+        # without the <files>, only the planned renames are resumed.
+        os.unlink(self.renamed(2))
+        assert main(resume) == 0
+        assert self.capsys.readouterr()[0].count('==>') == 1
+        assert os.path.exists(self.renamed(2))
+        assert os.path.exists(self.files[2])
+
+    def test_resume_update(self):
+        with redirected_io():
+            main(['update', '--journal=%s' % self.journal, '--album=X',
+                  self.files[0]])
+            self.read = []
+            main(['update', '--journal=%s' % self.journal, '--resume',
+                  '--album=X'] + self.files)
+        assert self.read == self.files[1:]
+        with redirected_io():
+            main(['update', '--journal=%s' % self.journal, '--album=X',
+                  self.files[0]])
+        with pytest.raises(SystemExit):
+            main(['update', '--resume', '--album=X', self.files[0]])
+
+    def test_undo(self):
+        with redirected_io():
+            main(['update', '--journal=%s' % self.journal, '--album=X',
+                  '--rename={title}'] + self.files)
+        # the third rename was done, but not logged.
+        with open(self.journal, 'rb') as journal:
+            records = journal.read().split('\x00\n')
+        with open(self.journal, 'wb') as journal:
+            journal.write('\x00\n'.join(records[:-2]) + '\x00\n')
+        shutil.copy(self.renamed(1), self.files[0])
+
+        with redirected_io() as stdout:
+            assert main(['undo', '--journal=%s' % self.journal]) == 1
+            assert stdout.getvalue().count('==>') == 2
+        assert os.path.exists(self.renamed(1))
+        assert all(os.path.exists(f) for f in self.files)
+        with redirected_io() as stdout:
+            assert main(['undo', '--journal=%s' % self.journal]) == 1
+            assert stdout.getvalue() == ''
+
+
+class TestDupes(LibraryTestCase):
+    # each fixture, and a copy of it with tags of another size.
+    fixtures = [(name, original)
+                for original in ('silence-44-s-v1.mp3', 'has-tags.m4a',
+                                 'silence.flac', 'silence.ogg', 'silence.opus')
+                for name in (original,
+                             '-retagged'.join(os.path.splitext(original)))]
+
+    def setUp(self):
+        super(TestDupes, self).setUp()
+        for f in self.files[1::2]:
+            meta = load(f)
+            meta['title'] = u'x' * 5000
+            tagcli.save(meta, f)
+
+    def payload(self, filename):
+        with tagcli._mapped(filename) as buf:
+            return ''.join(buf[start:end] for start, end
+                           in tagcli.payload(buf))
+
+    def test_payload(self):
+        for original, retagged in zip(self.files[::2], self.files[1::2]):
+            assert open(original).read() != open(retagged).read()
+            assert self.payload(original) == self.payload(retagged)
+        assert len(self.payload(self.files[0])) == 15070 - 128
+
+    def test_find_dupes(self):
+        groups, skipped = Library(jobs=2).find_dupes(
+            self.files + ['/tmp/a.bar'])
+        assert [files for _, _, _, files in groups] == [
+            self.files[0:2], self.files[2:4], self.files[6:8],
+            self.files[8:10]]
+        assert groups[0][1:3] == (15070 - 128, 3.7675)
+        # the FLAC fixture has no audio frames.
+        assert skipped[:2] == [(self.files[4], 'no audio payload'),
+                               (self.files[5], 'no audio payload')]
+        assert skipped[2][0] == '/tmp/a.bar'
+        assert 'No such file' in skipped[2][1]
+
+    def test_tolerance(self):
+        groups, _ = Library().find_dupes(self.files[:2], tolerance=-1)
+        assert groups == []
+
+    def test_dupes(self):
+        assert main(['dupes', self.files[2], self.files[0],
+                     self.files[3]]) == 0
+        out = self.capsys.readouterr()[0].splitlines()
+        assert len(out) == 1
+        group = json.loads(out[0])
+        assert group['files'] == [self.files[2], self.files[3]]
+        assert group['size'] == 1457
+        assert main(['dupes'] + self.files[1:3]) == 1
+
+
+class TestShard(LibraryTestCase):
+    fixtures = [('%s/%d.flac' % (album, track), 'silence.flac')
+                for album in ('a', 'b', 'b-sides') for track in range(1, 5)]
+
+    def dump(self, *options):
+        main(['dump', '--format=ndjson', '-r', self.top] + list(options))
+        return self.capsys.readouterr()[0]
+
+    def test_shard_of(self):
+        files = ['/srv/music/%02d.mp3' % i for i in range(1, 7)]
+        assert [tagcli.shard_of(f, 3) for f in files] == [3, 2, 1, 3, 3, 1]
+        assert tagcli.shard_of('/srv/music/01.mp3', 1) == 1
+
+    def test_shards(self):
+        outputs = [self.dump('--shard=%d/3' % i) for i in (1, 2, 3)]
+        dumped = [[json.loads(line)['file'] for line in output.splitlines()]
+                  for output in outputs]
+        assert sorted(sum(dumped, [])) == sorted(self.files)
+        for i, files in enumerate(dumped, 1):
+            assert all(tagcli.shard_of(str(f), 3) == i for f in files)
+
+    def test_invalid(self):
+        for shard in ('0/3', '4/3', '1', 'a/b'):
+            with pytest.raises(SystemExit):
+                self.dump('--shard=' + shard)
+
+    def test_trackstart(self):
+        main(['update', '--dry-run', '--trackstart=1', '--shard=2/3',
+              '-r', self.top])
+        out = self.capsys.readouterr()[0]
+        numbers = [(f, str(i)) for i, f in enumerate(self.files, 1)
+                   if tagcli.shard_of(f, 3) == 2]
+        assert out.count('tracknumber: ') == len(numbers)
+        for f, number in numbers:
+            assert 'Update tags for %s:\ntracknumber: %s\n' % (f, number) \
+                in out
+
+    def test_merge(self):
+        full = self.dump()
+        outputs = []
+        for i in (1, 2, 3):
+            outputs.append(str(self.tmpdir.join('tags.%d.ndjson' % i)))
+            self.tmpdir.join('tags.%d.ndjson' % i).write(
+                self.dump('--shard=%d/3' % i))
+        assert main(['merge'] + outputs) == 0
+        assert self.capsys.readouterr()[0] == full
+        # the files of b/ come before the ones of b-sides/, as walked.
+        assert full.index('/b/') < full.index('/b-sides/')
+
+    def test_merge_sort(self):
+        lines = self.dump().splitlines(True)
+        output = self.tmpdir.join('reversed.ndjson')
+        output.write(''.join(reversed(lines)))
+        with pytest.raises(SystemExit) as exc:
+            main(['merge', str(output)])
+        assert 'not in path order' in str(exc.value)
+        self.capsys.readouterr()
+        assert main(['merge', '--sort', str(output)]) == 0
+        assert self.capsys.readouterr()[0] == ''.join(lines)
+
+    def test_merge_stats(self):
+        outputs = []
+        for i in (1, 2):
+            outputs.append(str(self.tmpdir.join('stats.%d.json' % i)))
+            with redirected_io():
+                main(['--stats-json=' + outputs[-1], 'dump',
+                      '--shard=%d/2' % i, '-r', self.top])
+        shards = [json.load(open(f)) for f in outputs]
+        assert main(['merge', '--stats'] + outputs) == 0
+        merged = json.loads(self.capsys.readouterr()[0])
+        assert merged['files'] == len(self.files)
+        assert merged['wall'] == max(shard['wall'] for shard in shards)
+        assert merged['phases']['load']['count'] == len(self.files)
+        assert merged['shards'][1][:2] == ['dump', '--shard=2/2']
+
+
+class TestWatch(LibraryTestCase):
+    def setUp(self):
+        super(TestWatch, self).setUp()
+        self.top = str(self.tmpdir.mkdir('inbox'))
+
+    def drop(self, original, name):
+        # written aside, then moved in, like most downloaders do.
+        os.rename(self.copy(original, 'part'), os.path.join(self.top, name))
+        return os.path.join(self.top, name)
+
+    def test_inotify(self):
+        try:
+            watcher = tagcli.Inotify(self.top)
+        except OSError:
+            pytest.skip('inotify is not available')
+        try:
+            assert watcher.changes(0) == []
+            os.mkdir(os.path.join(self.top, 'sub'))
+            f = self.drop('silence.flac', os.path.join('sub', 'a.flac'))
+            open(os.path.join(self.top, 'cover.jpg'), 'w').close()
+            assert watcher.changes(1) == [f]
+            # a directory gone before its event is read.
+            os.mkdir(os.path.join(self.top, 'tmp'))
+            os.rmdir(os.path.join(self.top, 'tmp'))
+            assert watcher.changes(1) == []
+        finally:
+            watcher.close()
+
+    def test_poller(self):
+        watcher = tagcli.Poller(self.top, 0.05)
+        f = self.drop('silence.flac', 'a.flac')
+        assert watcher.changes(1) == [f]
+        assert watcher.changes(0.1) == []
+
+    def test_poller_vanished(self):
+        # the directories removed while they are listed are left out.
+        os.mkdir(os.path.join(self.top, 'tmp'))
+        f = self.drop('silence.flac', 'a.flac')
+
+        def listdir(top, listdir=tagcli._listdir):
+            if top.endswith('tmp'):
+                raise OSError(errno.ENOENT, 'No such file or directory', top)
+            return listdir(top)
+        self.monkeypatch.setattr(tagcli, '_listdir', listdir)
+        assert tagcli.Poller(self.top, 0.05).snapshot().keys() == [f]
+        os.rmdir(os.path.join(self.top, 'tmp'))
+        os.rename(self.top, self.top + '.gone')
+        assert tagcli.Poller(self.top, 0.05).snapshot() == {}
+
+    def watch(self, *options):
+        watcher = subprocess.Popen(
+            [sys.executable, 'tagcli.py', 'watch', '--settle=0.1',
+             '--rename={artist} - {title}', '--album=Inbox', self.top] +
+            list(options), stdout=subprocess.PIPE)
+        try:
+            time.sleep(0.5)
+            self.drop('silence.flac', 'a.flac')
+            self.drop('silence-44-s-v1.mp3', 'b.mp3')
+            renamed = [os.path.join(self.top, 'Artist - Silence.flac'),
+                       os.path.join(self.top, 'piman - Silence.mp3')]
+            for _ in range(100):
+                if all(os.path.exists(f) for f in renamed):
+                    break
+                time.sleep(0.05)
+            time.sleep(0.5)
+        finally:
+            watcher.terminate()
+            out = watcher.communicate()[0]
+        assert sorted(os.listdir(self.top)) == sorted(
+            os.path.basename(f) for f in renamed)
+        for f in renamed:
+            assert load(f)['album'] == ['Inbox']
+        # the renamed files are not handled again.
+        assert out.count('==>') == 2
+
+    def test_watch(self):
+        self.watch()
+
+    def test_watch_poll(self):
+        self.watch('--poll=0.1')
+
+
+class TestServe(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def server(self, tmpdir, capsys):
+        self.socket = str(tmpdir.join('tag.sock'))
+        self.capsys = capsys
+        # a relative socket, and requests from other directories.
+        server = subprocess.Popen([sys.executable,
+                                   os.path.abspath('tagcli.py'), 'serve',
+                                   '--socket=tag.sock', '--jobs=2'],
+                                  cwd=str(tmpdir))
+        for _ in range(100):
+            if os.path.exists(self.socket):
+                break
+            time.sleep(0.05)
+        yield
+        server.terminate()
+        server.wait()
+        assert not os.path.exists(self.socket)
+
+    def call(self, *argv):
+        status = main(['--connect=%s' % self.socket] + list(argv))
+        out, err = self.capsys.readouterr()
+        return status, out, err
+
+    def test_dump(self):
+        f = os.path.join('tests', 'data', 'silence-44-s-v1.mp3')
+        status, out, err = self.call('dump', f)
+        main(['dump', f])
+        assert (status, out, err) == (0, self.capsys.readouterr()[0], '')
+
+    def test_stdin(self):
+        f = os.path.join('tests', 'data', 'silence.flac')
+        stdin, sys.stdin = sys.stdin, StringIO(f + '\x00')
+        try:
+            assert self.call('find', '--newline', '--files-from=-',
+                             'title=Silence') == (0, f + '\n', '')
+        finally:
+            sys.stdin = stdin
+
+    def test_errors(self):
+        assert self.call('help') == (
+            1, '', "'help' is not a served command. See 'tag help serve'.\n")
+        status, out, err = self.call('dump')
+        assert status == 1 and err.startswith('usage: tag dump')
+        # the server is still up
+        assert self.call('dump', '/tmp/non_exist.bar') == (
+            0, 'Skipping /tmp/non_exist.bar: unknown extension: .bar\n', '')
+
+    def test_protocol(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket)
+        responses = sock.makefile('rb')
+        sock.sendall('not json\n')
+        assert json.loads(responses.readline())['stderr'] == \
+            'Invalid request.\n'
+        sock.sendall(json.dumps({'argv': ['dump', 'silence.opus'],
+                                 'cwd': os.path.abspath('tests/data')}) +
+                     '\n')
+        response = json.loads(responses.readline())
+        assert response['status'] == 0
+        assert response['stdout'].startswith('silence.opus\nOgg Opus')
+        sock.close()
+
+
 def test_help_command():
     with redirected_io() as stdout:
         main(['help', 'rename'])
@@ -199,7 +1422,7 @@ def test_main():
     with pytest.raises(SystemExit) as excinfo:
         main()
     assert excinfo.exconly() == """DocoptExit: Usage:
-  tag <command> [<options>...]"""
+  tag [options] <command> [<options>...]"""
 
 
 def test_missing_command():
@@ -207,3 +1430,23 @@ def test_missing_command():
         main(['non-exist'])
     assert excinfo.exconly() == \
         "SystemExit: 'non-exist' is not a tag command. See 'tag help'."
+
+
+def test_version():
+    with redirected_io() as out:
+        with pytest.raises(SystemExit) as excinfo:
+            main(['--version'])
+        assert out.getvalue() == 'tag version %s\n' % tagcli.__version__
+    assert excinfo.value.code is None
+
+
+def test_lazy_imports():
+    # importing tagcli must not pay for the imports of the commands.
+    modules = subprocess.Popen([
+        sys.executable, '-c',
+        'import sys, tagcli; print(sorted(sys.modules))'],
+        stdout=subprocess.PIPE,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    ).communicate()[0]
+    for name in ('mutagen', 'docopt', 'sqlite3', 'json', 'multiprocessing'):
+        assert "'%s'" % name not in modules